@@ -0,0 +1,118 @@
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import multiprocessing
+import sys
+
+from conllu_to_conll import add_conversion_arguments, conversion_filter_args, conversion_rewrites, convert_file
+from lib.conll import load_pos_precedence_profiles, pos_ranks
+
+MANIFEST_NAME = ".conversion-manifest.json"
+OUTPUT_SUFFIXES = {"conll2006": ".conll", "conll2009": ".conll", "conllu": ".conllu"}
+COMPRESSION_SUFFIXES = (".gz", ".xz", ".zst")
+# options naming files that change the output; the manifest records the md5 of their content
+OPTION_FILES = ('rewrite_rules', 'pos_profiles')
+
+
+def lang_from_filename(path):
+    # UD file names start with the language code, e.g. it-ud-test.conllu or fr_sequoia-ud-dev.conllu
+    return path.name.split("-")[0].split("_")[0]
+
+
+def file_hash(path):
+    md5 = hashlib.md5()
+    with path.open('rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def manifest_options(args):
+    """The conversion options as recorded in the manifest, with the content hash of every option file next to its path"""
+    options = {k: v for k, v in sorted(vars(args).items()) if k not in ('input_dir', 'output_dir', 'pattern', 'jobs', 'up_to_date')}
+    for name in OPTION_FILES:
+        if options[name]:
+            options[name + "_md5"] = file_hash(Path(options[name]))
+    return options
+
+
+def convert_job(job):
+    input_path, output_path, filter_args, output_format, print_fused_forms, print_comments, validate, rewrites = job
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    num_malformed = convert_file(str(input_path), output_path, filter_args, output_format, print_fused_forms, print_comments, validate=validate, rewrites=rewrites)
+    return output_path, num_malformed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Convert every conllu file below a directory, e.g. a whole UD release""")
+    parser.add_argument('input_dir', help="directory searched recursively for treebank files", type=Path)
+    parser.add_argument('output_dir', help="converted files are written here, mirroring the input tree", type=Path)
+    parser.add_argument('--pattern', help="globs for treebank files", nargs='+', default=["*.conllu", "*.conllu.gz", "*.conllu.xz", "*.conllu.zst"])
+    parser.add_argument('--jobs', help="number of worker processes", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--up_to_date', help="skip outputs newer than their input (mtime) or converted from identical input with identical options (hash)",
+                        choices=['mtime', 'hash', 'never'], default='mtime')
+    add_conversion_arguments(parser)
+
+    args = parser.parse_args()
+    if args.pos_profiles:
+        load_pos_precedence_profiles(args.pos_profiles)
+
+    manifest_path = args.output_dir / MANIFEST_NAME
+    manifest = {}
+    if args.up_to_date == 'hash' and manifest_path.exists():
+        with manifest_path.open() as f:
+            manifest = json.load(f)
+    options = manifest_options(args) if args.up_to_date == 'hash' else None
+
+    rewrites = conversion_rewrites(args)
+    jobs = []
+    new_manifest_entries = {}
+    input_paths = sorted(set(path for pattern in args.pattern for path in args.input_dir.rglob(pattern)))
+    for input_path in input_paths:
+        relative_path = input_path.relative_to(args.input_dir)
+        if relative_path.suffix in COMPRESSION_SUFFIXES:
+            relative_path = relative_path.with_suffix("")
+        output_path = (args.output_dir / relative_path).with_suffix(OUTPUT_SUFFIXES[args.output_format])
+        key = str(output_path.relative_to(args.output_dir))
+
+        if args.up_to_date == 'mtime':
+            if output_path.exists() and output_path.stat().st_mtime >= input_path.stat().st_mtime:
+                print("up to date: {}".format(output_path), file=sys.stderr)
+                continue
+        elif args.up_to_date == 'hash':
+            entry = {"input_md5": file_hash(input_path), "options": options}
+            if output_path.exists() and manifest.get(key) == entry:
+                print("up to date: {}".format(output_path), file=sys.stderr)
+                continue
+            new_manifest_entries[key] = entry
+
+        lang = lang_from_filename(input_path)
+        filter_args = conversion_filter_args(args, lang, pos_ranks(lang))
+        jobs.append((input_path, output_path, filter_args, args.output_format, args.print_fused_forms, args.print_comments, args.validate, rewrites))
+
+    print("converting {} files with {} processes".format(len(jobs), args.jobs), file=sys.stderr)
+    # One interpreter per worker for the whole run instead of one per file
+    num_malformed = 0
+    try:
+        with multiprocessing.Pool(args.jobs) as pool:
+            for output_path, num_file_malformed in pool.imap_unordered(convert_job, jobs):
+                print("converted: {}".format(output_path), file=sys.stderr)
+                num_malformed += num_file_malformed
+                key = str(output_path.relative_to(args.output_dir))
+                if key in new_manifest_entries:
+                    manifest[key] = new_manifest_entries[key]
+    finally:
+        # record what was converted even if a later file failed
+        if args.up_to_date == 'hash':
+            args.output_dir.mkdir(parents=True, exist_ok=True)
+            with manifest_path.open('w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+
+    if args.validate:
+        print("{} malformed sentences".format(num_malformed), file=sys.stderr)
+        if num_malformed:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from lib import instrument
+from lib.conll import CoNLLReader, DependencyTree, pos_ranks
+from lib.pipeline import SentencePipeline
+
+TEMPLATE_FILES = [("example/italian_sample.conllu", "conllu"), ("example/de_sample.conll2006dense", "conll2006dense")]
+SUITE_STAGES = ["read", "fused_forms", "deprel_suffixes", "node_properties", "arabic_diacritics", "render", "output"]
+
+
+def legacy_head_of(sent, n):
+    # The edge scan DependencyTree.head_of used before the head index, kept as a baseline
+    for u, v in sent.edges():
+        if v == n:
+            return u
+    return None
+
+
+def synthetic_chain_sentence(length):
+    """A right-branching sentence of the given length: each token hangs from the previous one"""
+    sent = DependencyTree()
+    for i in range(1, length + 1):
+        sent.add_node(i, {'form': 'w{}'.format(i), 'lemma': 'w', 'cpostag': 'NOUN', 'postag': 'S', 'feats': '_'})
+        sent.add_edge(i - 1, i, deprel='dep')
+    sent.graph['multi_tokens'] = {}
+    sent.graph['comment'] = []
+    return sent
+
+
+def bench_head_lookup(lengths, repeat):
+    cio = CoNLLReader()
+    print("length\tscan_all_heads\tindex_all_heads\tpathtoroot_deepest\twrite_sentence", file=sys.stderr)
+    for length in lengths:
+        sent = synthetic_chain_sentence(length)
+        nodes = list(range(1, length + 1))
+        t_scan = timeit.timeit(lambda: [legacy_head_of(sent, n) for n in nodes], number=repeat) / repeat
+        t_index = timeit.timeit(lambda: [sent.head_of(n) for n in nodes], number=repeat) / repeat
+        t_path = timeit.timeit(lambda: sent.pathtoroot(length), number=repeat) / repeat
+        columns = cio._columns_for_format("conll2006")
+        t_write = timeit.timeit(lambda: cio._write_sentence(sent, io.StringIO(), columns), number=repeat) / repeat
+        print("{}\t{:.6f}\t{:.6f}\t{:.6f}\t{:.6f}".format(length, t_scan, t_index, t_path, t_write))
+
+
+def bench_memory(filename, copies):
+    """Peak traced memory of holding copies x the sentences of filename as DependencyTree vs CompactSentence"""
+    cio = CoNLLReader()
+    print("representation\tsentences\tpeak_bytes", file=sys.stderr)
+    for name, reader in [("DependencyTree", cio.iter_conll_u), ("CompactSentence", cio.iter_conll_u_compact)]:
+        tracemalloc.start()
+        treebank = []
+        for _ in range(copies):
+            treebank.extend(reader(filename))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print("{}\t{}\t{}".format(name, len(treebank), peak))
+        del treebank
+
+
+def bench_parse(filename, repeat):
+    """Parse-only throughput of the CoNLL-U readers in tokens/sec; read_conll_u keeps the whole list, the others discard sentences as they are read"""
+    cio = CoNLLReader()
+    print("reader\ttokens\tseconds\ttokens_per_sec", file=sys.stderr)
+    for name, reader, num_tokens in [("iter_conll_u", cio.iter_conll_u, lambda s: len(s) - 1),
+                                     ("read_conll_u", cio.read_conll_u, lambda s: len(s) - 1),
+                                     ("iter_conll_u_compact", cio.iter_conll_u_compact, len)]:
+        best = None
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            tokens = sum(num_tokens(sent) for sent in reader(filename))
+            elapsed = timeit.default_timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print("{}\t{}\t{:.3f}\t{:.0f}".format(name, tokens, best, tokens / best))
+
+
+def template_sentences():
+    """The example sentences as lists of (form, lemma, cpostag, postag, feats, head, deprel), the raw material of the suite"""
+    cio = CoNLLReader()
+    readers = {"conllu": cio.iter_conll_u, "conll2006dense": cio.iter_conll_2006_dense}
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    templates = []
+    for filename, input_format in TEMPLATE_FILES:
+        for sent in readers[input_format](os.path.join(base_dir, filename)):
+            tokens = []
+            for token_i in range(1, max(sent.nodes()) + 1):
+                token_dict = sent.token_dict(token_i)
+                tokens.append(tuple(token_dict.get(key, '_') for key in ('form', 'lemma', 'cpostag', 'postag', 'feats', 'head', 'deprel')))
+            templates.append(tokens)
+    return templates
+
+
+def synthetic_sentence_lines(templates, sentence_length, mwt_density, rng):
+    """
+    CoNLL-U lines of one sentence of exactly sentence_length tokens, made of randomly chosen template
+    sentences: later templates hang from the root of the first one, and tokens whose head was cut off
+    at the length limit are attached to that root too. About mwt_density of the tokens are then grouped
+    pairwise into multiword tokens.
+    """
+    tokens = []
+    root = None
+    while len(tokens) < sentence_length:
+        offset = len(tokens)
+        for form, lemma, cpostag, postag, feats, head, deprel in rng.choice(templates):
+            head = head + offset if head else 0
+            if head == 0 and root is not None:
+                head, deprel = root, 'parataxis'
+            elif head == 0:
+                root = len(tokens) + 1
+            tokens.append([form, lemma, cpostag, postag, feats, head, deprel])
+    tokens = tokens[:sentence_length]
+    if root is None or root > sentence_length:
+        root = 1
+        tokens[0][5:] = [0, 'root']
+    for token in tokens:
+        if token[5] > sentence_length:
+            token[5:] = [root, 'dep']
+
+    pair_starts = list(range(1, sentence_length, 2))
+    num_spans = min(len(pair_starts), int(round(mwt_density * sentence_length / 2)))
+    span_starts = set(rng.sample(pair_starts, num_spans))
+
+    lines = []
+    for token_i, (form, lemma, cpostag, postag, feats, head, deprel) in enumerate(tokens, 1):
+        if token_i in span_starts:
+            lines.append("{}-{}\t{}\t_\t_\t_\t_\t_\t_\t_\t_\n".format(token_i, token_i + 1, form + tokens[token_i][0]))
+        lines.append("\t".join([str(token_i), form, lemma, cpostag, postag, feats, str(head), deprel, "_", "_"]) + "\n")
+    lines.append("\n")
+    return lines
+
+
+def write_synthetic_treebank(path, num_sentences, sentence_length, mwt_density, seed):
+    rng = random.Random(seed)
+    templates = template_sentences()
+    with open(path, 'w') as f:
+        for _ in range(num_sentences):
+            f.writelines(synthetic_sentence_lines(templates, sentence_length, mwt_density, rng))
+
+
+def time_suite_stages(filename, repeat):
+    """
+    Best time over repeat runs of a conllu_to_conll.py conversion as convert_file runs it: the sentences
+    are read, go through the SentencePipeline views and are written by a CoNLLWriter. "total" is timed
+    on a plain run; the stages of SUITE_STAGES run interleaved, so they come from a second, instrumented run,
+    and include the overhead of its timers.
+    """
+    cio = CoNLLReader()
+    pipeline = SentencePipeline.from_filter_args(replace_subtokens_with_fused_forms=True, lang="it", posPreferenceDict=pos_ranks("it"),
+                                                 remove_deprel_suffixes=True, node_properties_to_remove=["lemma", "feats"],
+                                                 remove_arabic_diacritics=True)
+    best = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output = os.path.join(tmp_dir, "out.conll")
+        for _ in range(repeat):
+            start = timeit.default_timer()
+            cio.write_conll(pipeline(cio.iter_treebank(filename, "conllu")), output, "conll2006")
+            times = {"total": timeit.default_timer() - start}
+            instrument.active = instrument.Instrumentation()
+            try:
+                cio.write_conll(pipeline(cio.iter_treebank(filename, "conllu")), output, "conll2006")
+                stage_seconds = instrument.active.seconds
+            finally:
+                instrument.active = None
+            for stage in SUITE_STAGES:
+                times[stage] = stage_seconds[stage]
+            for stage, seconds in times.items():
+                best[stage] = min(best.get(stage, seconds), seconds)
+    return best
+
+
+def run_suite_config(config):
+    """Synthesizes the treebank of one configuration and times it; runs in a fresh process so peak RSS is per configuration"""
+    num_sentences, sentence_length, mwt_density, seed, repeat = config
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = os.path.join(tmp_dir, "synthetic.conllu")
+        write_synthetic_treebank(filename, num_sentences, sentence_length, mwt_density, seed)
+        times = time_suite_stages(filename, repeat)
+    tokens = num_sentences * sentence_length
+    total = times["total"]
+    return {"sentences": num_sentences, "sentence_length": sentence_length, "mwt_density": mwt_density, "tokens": tokens,
+            "stages": {stage: {"seconds": round(times[stage], 6), "tokens_per_sec": round(tokens / times[stage]) if times[stage] else None}
+                       for stage in SUITE_STAGES},
+            "total_seconds": round(total, 6), "tokens_per_sec": round(tokens / total),
+            # ru_maxrss is in kilobytes on Linux
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def bench_suite(sizes, sentence_lengths, mwt_densities, seed, repeat, json_path):
+    configs = [(size, length, density, seed, repeat) for size in sizes for length in sentence_lengths for density in mwt_densities]
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for config in configs:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_suite_config, (config,))
+        print("sentences={sentences} length={sentence_length} mwt_density={mwt_density}: {tokens_per_sec} tokens/sec".format(**result), file=sys.stderr)
+        results.append(result)
+    report = {"python": sys.version.split()[0], "repeat": repeat, "seed": seed, "results": results}
+    if json_path == "-":
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    else:
+        with open(json_path, 'w') as f:
+            json.dump(report, f, indent=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Micro-benchmarks for the conversion tools""")
+    parser.add_argument('--lengths', help="sentence lengths to benchmark", type=int, nargs='+', default=[10, 50, 100, 500, 1000])
+    parser.add_argument('--repeat', help="repetitions per measurement", type=int, default=5)
+    parser.add_argument('--memory', help="conllu file to measure the memory footprint of both sentence representations on")
+    parser.add_argument('--copies', help="number of times the --memory file is loaded", type=int, default=1000)
+    parser.add_argument('--parse', help="conllu file to measure parse-only reader throughput on")
+    parser.add_argument('--suite', help="time every conversion stage on synthetic treebanks built from the example files", default=False, action="store_true")
+    parser.add_argument('--sizes', help="sentences per synthetic treebank with --suite", type=int, nargs='+', default=[2000])
+    parser.add_argument('--sentence_lengths', help="tokens per synthetic sentence with --suite", type=int, nargs='+', default=[10, 40])
+    parser.add_argument('--mwt_densities', help="fraction of tokens inside multiword tokens with --suite", type=float, nargs='+', default=[0.0, 0.1])
+    parser.add_argument('--seed', help="random seed of the synthetic treebanks", type=int, default=1)
+    parser.add_argument('--json', help="where --suite writes its JSON report, - for stdout", default="-")
+
+    args = parser.parse_args()
+
+    if args.memory:
+        bench_memory(args.memory, args.copies)
+    elif args.parse:
+        bench_parse(args.parse, args.repeat)
+    elif args.suite:
+        bench_suite(args.sizes, args.sentence_lengths, args.mwt_densities, args.seed, args.repeat, args.json)
+    else:
+        bench_head_lookup(args.lengths, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,154 @@
-from collections import defaultdict
+from collections import deque
 from itertools import islice
 from pathlib import Path
 import argparse
-import sys, copy
+import multiprocessing
+import sys
 
-from lib.conll import CoNLLReader
+from lib.conll import CoNLLReader, CoNLLWriter, TreebankCache, exit_on_broken_pipe, load_pos_precedence_profiles, pos_ranks
+from lib.normalize import Normalizer, SCRIPT_MARKS, UNICODE_FORMS
+from lib.pipeline import SentencePipeline
+from lib.rewrite import RewriteEngine
+from lib.instrument import add_instrumentation_arguments, enable_from_args
 
-def main():
-    parser = argparse.ArgumentParser(description="""Convert conllu to conll format""")
-    parser.add_argument('input', help="conllu file")
-    parser.add_argument('output', help="target file", type=Path)
+def convert_chunk(lines, filter_args, output_format, print_fused_forms, print_comments, validate=None, first_sentence=1, rewrites=None):
+    """Reads, filters and renders one chunk of sentences; runs in the worker processes of --jobs.
+    Returns the rendered sentences and the reports on malformed ones if validate is set."""
+    cio = CoNLLReader()
+    pipeline = SentencePipeline.from_filter_args(**filter_args)
+    reports = []
+    sentences = cio.iter_conll_u_lines(lines)
+    if validate:
+        sentences = validated(sentences, validate == "projective", reports.append, first_sentence)
+    if rewrites is not None:
+        sentences = rewrites(sentences)
+    return [cio.render_sentence(s, output_format, print_fused_forms, print_comments) for s in pipeline(sentences)], reports
+
+def validated(sentences, projective, report, first_sentence=1):
+    """Passes the well-formed sentences through and calls report with a message for every other one;
+    malformed sentences are left out, since they cannot be converted (e.g. a missing token id)"""
+    for sentence_number, sent in enumerate(sentences, first_sentence):
+        problems = sent.problems(projective)
+        if problems:
+            comments = sent.graph.get("comment")
+            report("sentence {}{}: {}".format(sentence_number, " ({})".format(comments[0]) if comments else "", "; ".join(problems)))
+        else:
+            yield sent
+
+def add_conversion_arguments(parser):
+    """Options shared by conllu_to_conll.py and batch_convert.py"""
     parser.add_argument('--replace_subtokens_with_fused_forms', help="By default removes fused tokens", default=False, action="store_true")
     parser.add_argument('--remove_deprel_suffixes', help="Restrict deprels to the common universal subset, e.g. nmod:tmod becomes nmod", default=False, action="store_true")
     parser.add_argument('--remove_node_properties', help="space-separated list of node properties to remove: form, lemma, cpostag, postag, feats", choices=['form', 'lemma', 'cpostag','postag','feats'],  metavar='prop', type=str, nargs='+')
-    parser.add_argument('--lang', help="specify a language 2-letter code", default="default")
     parser.add_argument('--output_format', choices=['conll2006', 'conll2009', 'conllu'], default="conll2006")
     parser.add_argument('--remove_arabic_diacritics', help="remove Arabic short vowels", default=False, action="store_true")
+    parser.add_argument('--strip_diacritics', help="remove the vowel marks of these scripts from the --normalize_fields", choices=sorted(SCRIPT_MARKS), metavar='script', nargs='+', default=[])
+    parser.add_argument('--unicode_normalization', help="bring the --normalize_fields to this Unicode normalization form", choices=UNICODE_FORMS)
+    parser.add_argument('--normalize_fields', help="fields changed by --strip_diacritics and --unicode_normalization", choices=['form', 'lemma'], metavar='field', nargs='+', default=['form', 'lemma'])
+    parser.add_argument('--remove_features', help="feature names to drop from the feats column, e.g. Gender Number", metavar='name', nargs='+')
     parser.add_argument('--print_comments',default=False,action="store_true")
     parser.add_argument('--print_fused_forms',default=False,action="store_true")
+    parser.add_argument('--rewrite_rules', help="JSON file with tree rewrite rules (see lib/rewrite.py), applied to every sentence before the other options")
+    parser.add_argument('--validate', help="report every input sentence that is not a well-formed tree (single root, no cycles, contiguous ids), with projective also non-projective ones; they are left out of the output, and the exit status is 1 if there are any",
+                        choices=['tree', 'projective'], nargs='?', const='tree')
+    parser.add_argument('--pos_profiles', help="JSON file with additional POS precedence lists per language code, e.g. {\"nl\": \"VERB AUX NOUN ADP DET\"}")
+
+def conversion_filter_args(args, lang, current_pos_precedence_list):
+    # As per Dec 2015 the lang variable is redundant once you have current_pos_precedence_list
+    # We keep it for future modifications, i.e. any language-specific modules
+    return dict(replace_subtokens_with_fused_forms=args.replace_subtokens_with_fused_forms, lang=lang,
+                posPreferenceDict=current_pos_precedence_list, node_properties_to_remove=args.remove_node_properties,
+                remove_deprel_suffixes=args.remove_deprel_suffixes, remove_arabic_diacritics=args.remove_arabic_diacritics,
+                normalizer=Normalizer(args.normalize_fields, args.strip_diacritics, args.unicode_normalization) if args.strip_diacritics or args.unicode_normalization else None,
+                features_to_remove=args.remove_features)
+
+def conversion_rewrites(args):
+    return RewriteEngine.from_json(args.rewrite_rules) if args.rewrite_rules else None
+
+def convert_file(input, output, filter_args, output_format, print_fused_forms=False, print_comments=False, cache=None, validate=None, rewrites=None):
+    """Converts input to output; returns the number of malformed sentences found if validate is set"""
+    cio = CoNLLReader(cache)
+    orig_treebank = cio.iter_treebank(input, "conllu")
+    pipeline = SentencePipeline.from_filter_args(**filter_args)
+    reports = []
+    if validate:
+        def report(message):
+            reports.append(message)
+            print("{}: {}".format(input, message), file=sys.stderr)
+        orig_treebank = validated(orig_treebank, validate == "projective", report)
+    if rewrites is not None:
+        orig_treebank = rewrites(orig_treebank)
+
+    # Sentences are read, filtered and written one at a time, so memory use does not grow with the treebank;
+    # the filters are views applied while writing, the parsed sentences are left as read
+    cio.write_conll(pipeline(orig_treebank), output, output_format, print_fused_forms=print_fused_forms, print_comments=print_comments)
+    return len(reports)
+
+def convert_parallel(cio, args, filter_args, rewrites=None):
+    # Chunks are submitted in file order and their results written back in the same order;
+    # at most 2 * jobs chunks are in flight, so memory stays bounded
+    pending = deque()
+    num_malformed = 0
+    first_sentence = 1
+
+    def write_next_chunk():
+        rendered_chunk, reports = pending.popleft().get()
+        for rendered in rendered_chunk:
+            writer.write_rendered(rendered)
+        for message in reports:
+            print("{}: {}".format(args.input, message), file=sys.stderr)
+        return len(reports)
+
+    with multiprocessing.Pool(args.jobs) as pool, CoNLLWriter.open(args.output, args.output_format) as writer:
+        for chunk in cio.iter_raw_chunks(args.input, args.chunk_size):
+            pending.append(pool.apply_async(convert_chunk, (chunk, filter_args, args.output_format, args.print_fused_forms, args.print_comments,
+                                                            args.validate, first_sentence, rewrites)))
+            first_sentence += args.chunk_size
+            if len(pending) >= 2 * args.jobs:
+                num_malformed += write_next_chunk()
+        while pending:
+            num_malformed += write_next_chunk()
+    return num_malformed
+
+def main():
+    parser = argparse.ArgumentParser(description="""Convert conllu to conll format""")
+    parser.add_argument('input', help="conllu file, optionally gzip/xz/zstd compressed")
+    parser.add_argument('output', help="target file; .gz and .xz are compressed, - writes to stdout", type=Path)
+    parser.add_argument('--lang', help="specify a language 2-letter code", default="default")
+    add_conversion_arguments(parser)
+    parser.add_argument('--jobs', help="number of worker processes; sentences are converted in parallel if > 1", type=int, default=1)
+    parser.add_argument('--chunk_size', help="sentences per work unit with --jobs", type=int, default=500)
+    parser.add_argument('--cache-dir', help="cache parsed treebanks in this directory (default: $UD_CONVERSION_CACHE if set); not used with --jobs")
+    parser.add_argument('--no-cache', help="do not use the parsed-treebank cache", default=False, action="store_true")
+    add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
+    enable_from_args(args)
 
     if sys.version_info < (3,0):
         print("Sorry, requires Python 3.x.") #suggestion: install anaconda python
         sys.exit(1)
 
-    POSRANKPRECEDENCEDICT = defaultdict(list)
-    POSRANKPRECEDENCEDICT["default"] = "VERB NOUN PROPN PRON ADJ NUM ADV INTJ AUX ADP DET PART CONJ SCONJ X PUNCT ".split(" ")
-    POSRANKPRECEDENCEDICT["de"] = "PROPN ADP DET ".split(" ")
-    POSRANKPRECEDENCEDICT["es"] = "VERB AUX PRON ADP DET".split(" ")
-    POSRANKPRECEDENCEDICT["fr"] = "VERB AUX PRON NOUN ADJ ADV ADP DET PART SCONJ CONJ".split(" ")
-    POSRANKPRECEDENCEDICT["it"] = "VERB AUX ADV PRON ADP DET".split(" ")
-
-    if args.lang in POSRANKPRECEDENCEDICT:
-        current_pos_precedence_list = POSRANKPRECEDENCEDICT[args.lang]
-    else:
-        current_pos_precedence_list = POSRANKPRECEDENCEDICT["default"]
+    if args.pos_profiles:
+        load_pos_precedence_profiles(args.pos_profiles)
+    current_pos_precedence_list = pos_ranks(args.lang)
 
     cio = CoNLLReader()
-    orig_treebank = cio.read_conll_u(args.input)#, args.keep_fused_forms, args.lang, POSRANKPRECEDENCEDICT)
-    modif_treebank = copy.copy(orig_treebank)
 
-    # As per Dec 2015 the args.lang variable is redundant once you have current_pos_precedence_list
-    # We keep it for future modifications, i.e. any language-specific modules
-    for s in modif_treebank:
-        s.filter_sentence_content(args.replace_subtokens_with_fused_forms, args.lang, current_pos_precedence_list,args.remove_node_properties,args.remove_deprel_suffixes,args.remove_arabic_diacritics)
+    filter_args = conversion_filter_args(args, args.lang, current_pos_precedence_list)
 
-    cio.write_conll(modif_treebank,args.output, args.output_format,print_fused_forms=args.print_fused_forms, print_comments=args.print_comments)
+    if args.jobs > 1:
+        num_malformed = convert_parallel(cio, args, filter_args, conversion_rewrites(args))
+    else:
+        num_malformed = convert_file(args.input, args.output, filter_args, args.output_format, args.print_fused_forms, args.print_comments,
+                                     TreebankCache.from_environment(args.cache_dir, args.no_cache), args.validate, conversion_rewrites(args))
+    if args.validate:
+        print("{} malformed sentences".format(num_malformed), file=sys.stderr)
+        if num_malformed:
+            sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    try:
+        main()
+    except BrokenPipeError:
+        exit_on_broken_pipe()
\ No newline at end of file
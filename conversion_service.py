@@ -0,0 +1,336 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+import argparse
+import asyncio
+import io
+import json
+import sys
+import time
+
+from lib.conll import CoNLLReader, load_pos_precedence_profiles, pos_ranks
+from lib.rewrite import RewriteEngine
+from conllu_to_conll import add_conversion_arguments, conversion_filter_args, convert_chunk
+
+# A long-running conversion service, so that callers converting one document at a time do not pay
+# the interpreter and networkx start-up for every call:
+#
+#   python conversion_service.py --port 8155 --workers 4
+#   curl --data-binary @doc.conllu 'http://localhost:8155/convert?lang=it&replace_subtokens_with_fused_forms&output_format=conllu'
+#
+# The query string takes the options of conllu_to_conll.py without the leading --; options with several
+# values repeat the key or separate the values with spaces. --pos_profiles and --rewrite_rules name files
+# on the server, so they are options of the service itself. The payload is split into chunks of
+# sentences that are converted by a process pool and streamed back in order as they are done.
+# GET /metrics returns request counts and latencies as JSON.
+
+STATUS_TEXTS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                411: "Length Required", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+class RequestError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ConversionAborted(RequestError):
+    """A conversion that failed after the 200 head was sent; the stream ends with an error line instead"""
+
+
+class OptionParser(argparse.ArgumentParser):
+    # bad options are the client's error, not a reason to exit
+    def error(self, message):
+        raise RequestError(400, message)
+
+
+def request_option_parser():
+    parser = OptionParser(prog="/convert", add_help=False)
+    parser.add_argument('--lang', default="default")
+    add_conversion_arguments(parser)
+    return parser
+
+
+def request_options(parser, query):
+    argv = []
+    for key, value in parse_qsl(query, keep_blank_values=True):
+        argv.append("--" + key)
+        argv.extend(value.split())
+    options = parser.parse_args(argv)
+    # both name files on the server
+    if options.pos_profiles:
+        raise RequestError(400, "pos_profiles can only be loaded when the service starts")
+    if options.rewrite_rules:
+        raise RequestError(400, "rewrite_rules can only be loaded when the service starts")
+    return options
+
+
+class ServiceMetrics(object):
+    """Request counts and the latencies of the last requests, from arrival to the last byte sent"""
+
+    WINDOW = 1000
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.requests = 0
+        self.errors = 0
+        self.sentences = 0
+        self.malformed = 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.latencies = deque(maxlen=self.WINDOW)
+        self.queue_waits = deque(maxlen=self.WINDOW)
+
+    def record(self, status, latency, queue_wait, num_sentences):
+        self.requests += 1
+        if status != 200:
+            self.errors += 1
+        self.sentences += num_sentences
+        self.latencies.append(latency)
+        self.queue_waits.append(queue_wait)
+
+    def summary(self):
+        return {"uptime_seconds": round(time.perf_counter() - self.started, 3),
+                "requests": self.requests,
+                "errors": self.errors,
+                "sentences": self.sentences,
+                "malformed_sentences": self.malformed,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "latency_seconds": percentiles(self.latencies),
+                "queue_wait_seconds": percentiles(self.queue_waits)}
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = sorted(values)
+    return {"mean": round(sum(values) / len(values), 6),
+            "p50": round(values[len(values) // 2], 6),
+            "p95": round(values[min(len(values) - 1, int(len(values) * 0.95))], 6),
+            "max": round(values[-1], 6)}
+
+
+class ConversionService(object):
+
+    def __init__(self, workers, max_concurrent, max_waiting, chunk_size, max_request_bytes, rewrites=None):
+        self.pool = ProcessPoolExecutor(workers)
+        self.workers = workers
+        # at most max_concurrent requests are converted at a time and max_waiting more wait for their turn
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.max_waiting = max_waiting
+        self.chunk_size = chunk_size
+        self.max_request_bytes = max_request_bytes
+        # the rewrite rules of --rewrite_rules, applied to every request
+        self.rewrites = rewrites
+        self.parser = request_option_parser()
+        self.metrics = ServiceMetrics()
+        self.cio = CoNLLReader()
+
+    async def handle(self, reader, writer):
+        arrived = time.perf_counter()
+        status, queue_wait, num_sentences = 500, 0.0, 0
+        target = None
+        try:
+            method, target, headers = await read_request_head(reader)
+            url = urlsplit(target)
+            if url.path == "/metrics":
+                if method != "GET":
+                    raise RequestError(405, "use GET for /metrics")
+                status = 200
+                await send_response(writer, 200, "application/json", json.dumps(self.metrics.summary(), indent=2) + "\n")
+                return
+            if url.path != "/convert":
+                raise RequestError(404, "unknown path {}, use /convert or /metrics".format(url.path))
+            if method != "POST":
+                raise RequestError(405, "use POST for /convert")
+            options = request_options(self.parser, url.query)
+            try:
+                filter_args = conversion_filter_args(options, options.lang, pos_ranks(options.lang))
+            except ValueError as e:
+                raise RequestError(400, str(e))
+            payload = await read_payload(reader, headers, self.max_request_bytes)
+
+            if self.slots.locked() and self.metrics.waiting >= self.max_waiting:
+                raise RequestError(503, "too many requests waiting")
+            self.metrics.waiting += 1
+            try:
+                await self.slots.acquire()
+            finally:
+                self.metrics.waiting -= 1
+            queue_wait = time.perf_counter() - arrived
+            self.metrics.in_flight += 1
+            try:
+                status = 200
+                num_sentences = await self.convert(options, filter_args, payload, writer)
+            finally:
+                self.metrics.in_flight -= 1
+                self.slots.release()
+        except ConversionAborted as e:
+            status = e.status
+        except RequestError as e:
+            status = e.status
+            await send_response(writer, e.status, "text/plain", str(e) + "\n")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            status = 400
+        except Exception as e:
+            status = 500
+            print("{}: {}: {}".format(target, type(e).__name__, e), file=sys.stderr)
+        finally:
+            writer.close()
+            if target is not None and not target.startswith("/metrics"):
+                latency = time.perf_counter() - arrived
+                self.metrics.record(status, latency, queue_wait, num_sentences)
+                print("{} {} {} sentences {:.3f}s".format(target, status, num_sentences, latency), file=sys.stderr)
+
+    async def convert(self, options, filter_args, payload, writer):
+        """Converts the payload chunk by chunk in the process pool, streaming the output back in order"""
+        loop = asyncio.get_running_loop()
+        # split at \n only, like a file is read
+        lines = list(io.StringIO(payload))
+        # the last sentence need not be followed by a blank line
+        if lines and lines[-1].strip("\n"):
+            lines.append("\n")
+
+        pending = deque()
+        first_sentence = 1
+        num_sentences = 0
+        head_sent = False
+
+        async def send_next_chunk():
+            nonlocal head_sent
+            try:
+                rendered_chunk, reports = await pending.popleft()
+            except Exception as e:
+                for future in pending:
+                    future.cancel()
+                message = "cannot convert the payload: {}".format(e)
+                if not head_sent:
+                    raise RequestError(400, message)
+                # the status is out already: end the stream with an error line and without the last chunk
+                await send_chunk(writer, "# ERROR " + message + "\n")
+                raise ConversionAborted(400, message)
+            # the head goes out with the first converted chunk, so a payload that cannot be read gets a 400
+            if not head_sent:
+                await send_head(writer, 200, "text/plain; charset=utf-8", chunked=True)
+                head_sent = True
+            for message in reports:
+                print("request {}: {}".format(id(writer), message), file=sys.stderr)
+            self.metrics.malformed += len(reports)
+            if rendered_chunk:
+                # an empty line after every sentence, as CoNLLWriter writes them
+                await send_chunk(writer, "".join(rendered + "\n" for rendered in rendered_chunk))
+            return len(rendered_chunk)
+
+        for chunk in self.cio.iter_raw_chunks_lines(lines, self.chunk_size):
+            pending.append(loop.run_in_executor(self.pool, convert_chunk, chunk, filter_args, options.output_format,
+                                                options.print_fused_forms, options.print_comments, options.validate,
+                                                first_sentence, self.rewrites))
+            first_sentence += self.chunk_size
+            if len(pending) >= 2 * self.workers:
+                num_sentences += await send_next_chunk()
+        while pending:
+            num_sentences += await send_next_chunk()
+        if not head_sent:
+            await send_head(writer, 200, "text/plain; charset=utf-8", chunked=True)
+        await send_chunk(writer, "")
+        return num_sentences
+
+
+async def read_request_head(reader):
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    parts = request_line.split()
+    if len(parts) != 3:
+        raise RequestError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode("latin-1").strip()
+        if not line:
+            break
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+    return parts[0], parts[1], headers
+
+
+async def read_payload(reader, headers, max_bytes):
+    if "content-length" not in headers:
+        raise RequestError(411, "send the CoNLL-U payload with a Content-Length")
+    try:
+        length = int(headers["content-length"])
+    except ValueError:
+        raise RequestError(400, "invalid Content-Length: {}".format(headers["content-length"]))
+    if length > max_bytes:
+        raise RequestError(413, "payload larger than {} bytes".format(max_bytes))
+    try:
+        return (await reader.readexactly(length)).decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise RequestError(400, "payload is not UTF-8: {}".format(e))
+
+
+async def send_head(writer, status, content_type, length=None, chunked=False):
+    head = ["HTTP/1.1 {} {}".format(status, STATUS_TEXTS.get(status, "Internal Server Error")),
+            "Content-Type: " + content_type, "Connection: close"]
+    if chunked:
+        head.append("Transfer-Encoding: chunked")
+    elif length is not None:
+        head.append("Content-Length: {}".format(length))
+    writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+    await writer.drain()
+
+
+async def send_response(writer, status, content_type, body):
+    body = body.encode("utf-8")
+    await send_head(writer, status, content_type, len(body))
+    writer.write(body)
+    await writer.drain()
+
+
+async def send_chunk(writer, text):
+    # an empty chunk ends the response
+    data = text.encode("utf-8")
+    writer.write("{:x}\r\n".format(len(data)).encode("latin-1") + data + b"\r\n")
+    await writer.drain()
+
+
+async def serve(args):
+    rewrites = RewriteEngine.from_json(args.rewrite_rules) if args.rewrite_rules else None
+    service = ConversionService(args.workers, args.max_concurrent, args.max_waiting, args.chunk_size, args.max_request_bytes, rewrites)
+    if args.socket:
+        server = await asyncio.start_unix_server(service.handle, path=args.socket)
+        where = args.socket
+    else:
+        server = await asyncio.start_server(service.handle, args.host, args.port)
+        where = "http://{}:{}".format(args.host, args.port)
+    print("Converting on {} with {} worker processes".format(where, args.workers), file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.pool.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="""Serve conllu to conll conversion over HTTP, on a TCP port or a Unix socket""")
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8155)
+    parser.add_argument('--socket', help="listen on this Unix socket path instead of --host and --port")
+    parser.add_argument('--workers', help="number of worker processes converting sentences", type=int, default=2)
+    parser.add_argument('--max_concurrent', help="requests converted at the same time; later ones wait", type=int, default=4)
+    parser.add_argument('--max_waiting', help="requests that may wait for their turn; more are refused with 503", type=int, default=64)
+    parser.add_argument('--chunk_size', help="sentences per work unit", type=int, default=200)
+    parser.add_argument('--max_request_bytes', help="largest accepted payload", type=int, default=64 << 20)
+    parser.add_argument('--pos_profiles', help="JSON file with additional POS precedence lists per language code")
+    parser.add_argument('--rewrite_rules', help="JSON file with tree rewrite rules (see lib/rewrite.py), applied to every request")
+    args = parser.parse_args()
+
+    if args.pos_profiles:
+        load_pos_precedence_profiles(args.pos_profiles)
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,23 @@
 from pathlib import Path
 import argparse
 import sys
-import random
 
-from lib.conll import CoNLLReader
+from lib.conll import CoNLLReader, CoNLLWriter, TreebankCache
+from lib.instrument import add_instrumentation_arguments, enable_from_args
 
 def main():
     parser = argparse.ArgumentParser(description="""Extract data based on comments info""")
-    parser.add_argument('input', help="conllu file")
+    parser.add_argument('input', help="conllu file, optionally gzip/xz/zstd compressed")
     parser.add_argument('output', help="target file", type=Path)
     parser.add_argument('--input-format', choices=['conll2006', 'conll2006dense', 'conllu'], default="conllu")
+    parser.add_argument('--cache-dir', help="cache parsed treebanks in this directory (default: $UD_CONVERSION_CACHE if set)")
+    parser.add_argument('--no-cache', help="do not use the parsed-treebank cache", default=False, action="store_true")
     parser.add_argument('--mapping', help="mapping file", required=True)
+    parser.add_argument('--output-format', choices=['conll2006', 'conllu'], default="conll2006", help="conllu output keeps comments and fused forms")
+    add_instrumentation_arguments(parser)
 
     args = parser.parse_args()
+    enable_from_args(args)
 
     lines=[line.strip() for line in open(args.mapping)]
     mapping={}
@@ -22,37 +27,35 @@ def main():
     
     print("loaded mapping:", mapping, file=sys.stderr)
 
-    cio = CoNLLReader()
-    if args.input_format == "conllu":
-        orig_treebank = cio.read_conll_u(args.input)
-    elif args.input_format == "conll2006":
-        orig_treebank = cio.read_conll_2006(args.input)
-    elif args.input_format == "conll2006dense":
-        orig_treebank = cio.read_conll_2006_dense(args.input)
-    num_trees = len(orig_treebank)
-
-    print("Loaded treebank {} with {} sentences".format(args.input,num_trees), file=sys.stderr)
-    
-    split = {mapping[k] : [] for k in mapping.keys()}
     default = "various"
-    split[default] = []
-
-    for tree in orig_treebank:
-        found_mapping=False
-        for token in " ".join(tree.graph['comment']).strip().split():
-            if token in mapping:
-                split[mapping[token]].append(tree)
-                found_mapping=True
-                continue
-        if not found_mapping:
-            split[default].append(tree)
-
-    for key in split:
-        print(key, len(split[key]), file=sys.stderr)
-        cio.write_conll(split[key], Path(args.output.name + "_" + key), "conll2006")
-    #sample = orig_treebank[0:args.k]
-    #print("sampled {} trees. seed: {}".format(len(sample), args.seed))
-    #cio.write_conll(sample, args.output, "conll2006")
+    genres = sorted(set(mapping.values()) | {default})
+    print_extras = args.output_format == "conllu"
+
+    cio = CoNLLReader(TreebankCache.from_environment(args.cache_dir, args.no_cache))
+    # All genre outputs are open from the start and every tree goes out as soon as it is read
+    writers = {key: CoNLLWriter.open(Path(args.output.name + "_" + key), args.output_format, print_fused_forms=print_extras, print_comments=print_extras)
+               for key in genres}
+    num_trees = 0
+    try:
+        for tree in cio.iter_treebank(args.input, args.input_format):
+            num_trees += 1
+            found_mapping=False
+            # a tree goes to the genre of every matching comment token, as many times as it matches;
+            # one dict lookup per whitespace-separated token
+            for comment in tree.graph.get('comment', []):
+                for token in comment.split():
+                    if token in mapping:
+                        writers[mapping[token]].write(tree)
+                        found_mapping=True
+            if not found_mapping:
+                writers[default].write(tree)
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    print("Read treebank {} with {} sentences".format(args.input,num_trees), file=sys.stderr)
+    for key in genres:
+        print(key, writers[key].num_sentences, file=sys.stderr)
 
 if __name__ == "__main__":
     main()
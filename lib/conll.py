@@ -1,6 +1,82 @@
 import networkx as nx
-from collections import Counter
-import re
+from array import array
+import io
+from collections import defaultdict
+from itertools import chain, islice, repeat
+import copy
+import gc
+import gzip
+import hashlib
+import json
+import lzma
+import mmap
+import os
+import pickle
+import queue
+import sys
+import threading
+
+from lib import instrument
+from lib.feats import feats_of, interned_bundles
+from lib.normalize import ARABIC_FORMS
+
+
+# Preference order of UPOS tags when choosing the head of a fused-form span, per language code
+POSRANKPRECEDENCEDICT = defaultdict(list)
+POSRANKPRECEDENCEDICT["default"] = "VERB NOUN PROPN PRON ADJ NUM ADV INTJ AUX ADP DET PART CONJ SCONJ X PUNCT ".split(" ")
+POSRANKPRECEDENCEDICT["de"] = "PROPN ADP DET ".split(" ")
+POSRANKPRECEDENCEDICT["es"] = "VERB AUX PRON ADP DET".split(" ")
+POSRANKPRECEDENCEDICT["fr"] = "VERB AUX PRON NOUN ADJ ADV ADP DET PART SCONJ CONJ".split(" ")
+POSRANKPRECEDENCEDICT["it"] = "VERB AUX ADV PRON ADP DET".split(" ")
+
+def pos_precedence_list(lang):
+    if lang in POSRANKPRECEDENCEDICT:
+        return POSRANKPRECEDENCEDICT[lang]
+    else:
+        return POSRANKPRECEDENCEDICT["default"]
+
+
+class PosRanks(dict):
+    """
+    UPOS -> rank (0 is preferred) for a POS precedence list, for constant-time span-head choice.
+    UPOS tags missing from the list rank after every listed tag instead of raising ValueError.
+    """
+
+    def __init__(self, precedence):
+        dict.__init__(self)
+        for upos in precedence:
+            if upos and upos not in self:
+                self[upos] = len(self)
+
+    def __missing__(self, upos):
+        return len(self)
+
+
+# Language profiles: the precedence lists above compiled once into rank tables
+POSRANKTABLES = {}
+
+def register_pos_precedence(lang, precedence):
+    """Adds or replaces the POS precedence profile of lang; precedence is a list or a space-separated string of UPOS tags"""
+    if isinstance(precedence, str):
+        precedence = precedence.split()
+    POSRANKPRECEDENCEDICT[lang] = list(precedence)
+    POSRANKTABLES[lang] = PosRanks(precedence)
+
+def load_pos_precedence_profiles(path):
+    """Registers the profiles of a JSON file mapping language codes to precedence lists, e.g. {"nl": "VERB AUX NOUN ADP DET"}"""
+    with open(path) as f:
+        profiles = json.load(f)
+    for lang, precedence in profiles.items():
+        register_pos_precedence(lang, precedence)
+
+def pos_ranks(lang):
+    if lang in POSRANKTABLES:
+        return POSRANKTABLES[lang]
+    else:
+        return POSRANKTABLES["default"]
+
+for lang, precedence in list(POSRANKPRECEDENCEDICT.items()):
+    register_pos_precedence(lang, precedence)
 
 
 #TODO make these parse functions static methods of ConllReder
@@ -26,6 +102,176 @@ def parse_deps(dep_str):
     return [(int(pair[0]), pair[1]) for pair in dep_pairs]
 
 
+def token_depths(heads):
+    """Number of ancestors (root included) of every token, given heads[i] = head of token i.
+    Tokens on a cycle or under an unknown head get the depth reached before the walk broke off."""
+    depths = [None] * len(heads)
+    depths[0] = 0
+    for i in range(1, len(heads)):
+        path = []
+        visiting = set()
+        n = i
+        while 0 < n < len(heads) and depths[n] is None and n not in visiting:
+            visiting.add(n)
+            path.append(n)
+            n = heads[n]
+        depth = depths[n] if 0 <= n < len(heads) and depths[n] is not None else 0
+        for m in reversed(path):
+            depth += 1
+            depths[m] = depth
+    return depths
+
+def heads_form_tree(heads):
+    """True if heads (heads[i] = head of token i, index 0 the root) describes a tree rooted in 0"""
+    depths = token_depths(heads)
+    for token_i in range(1, len(heads)):
+        head = heads[token_i]
+        if not 0 <= head < len(heads) or depths[token_i] != depths[head] + 1:
+            return False
+    return True
+
+def tree_problems(heads, projective=False):
+    """Everything that keeps heads (heads[i] = head of token i, index 0 the root) from describing a
+    well-formed dependency tree, as a list of messages; empty if it is one. heads[i] is None for a
+    token id that does not occur, and any other value outside the sentence is an invalid head.
+    With projective, crossing arcs are reported too. Runs in O(n)."""
+    problems = []
+    num_ids = len(heads)
+    present = [token_i for token_i in range(1, num_ids) if heads[token_i] is not None]
+    missing = [token_i for token_i in range(1, num_ids) if heads[token_i] is None]
+    if missing:
+        problems.append("token ids not contiguous, missing: " + ", ".join(map(str, missing)))
+    missing_ids = set(missing)
+    invalid = [token_i for token_i in present if not 0 <= heads[token_i] < num_ids or heads[token_i] == token_i or heads[token_i] in missing_ids]
+    if invalid:
+        problems.append("no valid head: " + ", ".join(map(str, invalid)))
+    roots = [token_i for token_i in present if heads[token_i] == 0]
+    if len(roots) != 1:
+        problems.append("{} tokens attached to the root{}".format(len(roots), ": " + ", ".join(map(str, roots)) if roots else ""))
+
+    # Walk up from every token; 1 marks the current path, 2 tokens known to end outside a cycle
+    state = [0] * num_ids
+    state[0] = 2
+    for token_i in present:
+        path = []
+        n = token_i
+        while 0 < n < num_ids and heads[n] is not None and state[n] == 0:
+            state[n] = 1
+            path.append(n)
+            n = heads[n]
+        if 0 < n < num_ids and state[n] == 1 and n != path[-1]:
+            problems.append("cycle: " + ", ".join(map(str, sorted(path[path.index(n):]))))
+        for m in path:
+            state[m] = 2
+
+    if projective and not problems:
+        # a tree is projective iff the tokens of every subtree are contiguous:
+        # accumulate subtree size and extent bottom-up, deepest tokens first
+        depths = token_depths(heads)
+        by_depth = [[] for _ in range(max(depths) + 1)]
+        for token_i in range(1, num_ids):
+            by_depth[depths[token_i]].append(token_i)
+        low = list(range(num_ids))
+        high = list(range(num_ids))
+        size = [1] * num_ids
+        for level in reversed(by_depth):
+            for token_i in level:
+                head = heads[token_i]
+                low[head] = min(low[head], low[token_i])
+                high[head] = max(high[head], high[token_i])
+                size[head] += size[token_i]
+        nonprojective = [token_i for token_i in range(1, num_ids) if high[token_i] - low[token_i] + 1 != size[token_i]]
+        if nonprojective:
+            problems.append("non-projective subtrees under: " + ", ".join(map(str, nonprojective)))
+    return problems
+
+def choose_spanhead(span_nodes, depths, cpostags, pos_ranks):
+    """Picks the head of a fused-form span: the single highest node, or else the highest node
+    whose UPOS ranks best in the PosRanks table pos_ranks"""
+    distancestoroot = [depths[x] for x in span_nodes]
+    shortestdistancetoroot = min(distancestoroot)
+    # Heuristic Nr 1: If there is one single highest node in the span, it becomes the head
+    if distancestoroot.count(shortestdistancetoroot) == 1:
+        return span_nodes[distancestoroot.index(shortestdistancetoroot)]
+
+    # Heuristic Nr 2: Choose by POS ranking the best head out of the highest nodes
+    best_rank = len(pos_ranks) + 1
+    candidate_head = - 1
+    for x, distance in zip(span_nodes, distancestoroot):
+        if distance == shortestdistancetoroot and pos_ranks[cpostags[x]] < best_rank:
+            best_rank = pos_ranks[cpostags[x]]
+            candidate_head = x
+    return candidate_head
+
+def merge_fused_spans(heads, cpostags, multi_tokens, pos_precedence_list):
+    """Collapses every multiword-token span onto its span head, working on plain arrays.
+
+    heads[i] and cpostags[i] describe token i (index 0 is the root). For every span the head is
+    chosen with choose_spanhead, the dependents of the other span members are reattached to
+    the span head and the other members are dropped. Returns the new heads (still indexed by
+    old token ids), the renumbering old id -> new id (None for dropped tokens) and a dict
+    span head -> multi_tokens key. pos_precedence_list is a PosRanks table or a plain precedence list."""
+    pos_ranks = pos_precedence_list if isinstance(pos_precedence_list, PosRanks) else PosRanks(pos_precedence_list)
+    heads = list(heads)
+    depths = token_depths(heads)
+    spanheads = {}
+    for fusedform_idx in sorted(multi_tokens):
+        fusedform_start, fusedform_end = multi_tokens[fusedform_idx]["id"]
+        spanhead = choose_spanhead(list(range(fusedform_start, fusedform_end + 1)), depths, cpostags, pos_ranks)
+        spanheads[spanhead] = fusedform_idx
+
+    children = [set() for _ in heads]
+    for d in range(1, len(heads)):
+        if 0 <= heads[d] < len(heads):
+            children[heads[d]].add(d)
+
+    removed = [False] * len(heads)
+    # Spans closer to the root go first, as in a topological order of the span heads
+    for spanhead in sorted(spanheads, key=lambda x: depths[x]):
+        fusedform_start, fusedform_end = multi_tokens[spanheads[spanhead]]["id"]
+        for int_dep in range(fusedform_start, fusedform_end + 1):
+            if int_dep == spanhead or removed[int_dep]:
+                continue
+            # every token below an internal dependent hangs from the span head afterwards
+            stack = list(children[int_dep])
+            while stack:
+                ext_dep = stack.pop()
+                stack.extend(children[ext_dep])
+                children[heads[ext_dep]].discard(ext_dep)
+                heads[ext_dep] = spanhead
+                children[spanhead].add(ext_dep)
+            if 0 <= heads[int_dep] < len(heads):
+                children[heads[int_dep]].discard(int_dep)
+            removed[int_dep] = True
+
+    new_ids = [None] * len(heads)
+    new_id = 0
+    for old_id in range(len(heads)):
+        if not removed[old_id]:
+            new_ids[old_id] = new_id
+            new_id += 1
+    return heads, new_ids, spanheads
+
+def renumber_fused_spans(heads, cpostags, multi_tokens, pos_precedence_list):
+    """merge_fused_spans followed by the renumbering of the surviving tokens. Returns the heads of the
+    merged sentence (index 0 the root), the old id of every merged token, the renumbering old id -> new id
+    (None for dropped tokens) and the dict span head -> multi_tokens key."""
+    new_heads, new_ids, spanheads = merge_fused_spans(heads, cpostags, multi_tokens, pos_precedence_list)
+    kept = [old_id for old_id, new_id in enumerate(new_ids) if new_id is not None]
+    merged_heads = [-1] + [new_ids[new_heads[old_id]] for old_id in kept[1:]]
+    return merged_heads, kept, new_ids, spanheads
+
+def report_not_a_tree(sent, merged_heads):
+    """Reports a sentence whose merged_heads (see renumber_fused_spans) are not a tree on stderr and as
+    a not_a_tree instrumentation event; returns whether they are a tree"""
+    if heads_form_tree(merged_heads):
+        return True
+    print("Not a tree after fused-form heuristics:",sent.get_sentence_as_string(), file=sys.stderr)
+    if instrument.active is not None:
+        instrument.active.event("not_a_tree", sent.get_sentence_as_string())
+    return False
+
+
 
 
 class DependencyTree(nx.DiGraph):
@@ -36,21 +282,105 @@ class DependencyTree(nx.DiGraph):
     """
 
     def __init__(self):
+        # results of problems(), per value of projective, until the next structural change
+        self._problems = {}
         nx.DiGraph.__init__(self)
+        # Head index kept in sync with the edges, so head queries do not scan the graph:
+        # heads maps a dependent to its primary head, secondary_heads maps a dependent
+        # to the set of heads of its secondary=True (enhanced dependency) edges
+        self.heads = {}
+        self.secondary_heads = {}
+
+    def add_node(self, n, attr_dict=None, **attr):
+        nx.DiGraph.add_node(self, n, attr_dict, **attr)
+        self._problems.clear()
+
+    def add_nodes_from(self, nodes, **attr):
+        nx.DiGraph.add_nodes_from(self, nodes, **attr)
+        self._problems.clear()
+
+    def _index_edge(self, u, v):
+        self._problems.clear()
+        if self[u][v].get("secondary", False):
+            self.secondary_heads.setdefault(v, set()).add(u)
+        else:
+            self.heads[v] = u
+
+    def _unindex_edge(self, u, v):
+        self._problems.clear()
+        if self.heads.get(v) == u:
+            del self.heads[v]
+        if v in self.secondary_heads:
+            self.secondary_heads[v].discard(u)
+            if not self.secondary_heads[v]:
+                del self.secondary_heads[v]
+
+    def add_edge(self, u, v, attr_dict=None, **attr):
+        nx.DiGraph.add_edge(self, u, v, attr_dict, **attr)
+        self._index_edge(u, v)
+
+    def add_edges_from(self, ebunch, attr_dict=None, **attr):
+        ebunch = list(ebunch)
+        nx.DiGraph.add_edges_from(self, ebunch, attr_dict, **attr)
+        for e in ebunch:
+            self._index_edge(e[0], e[1])
+
+    def remove_edge(self, u, v):
+        nx.DiGraph.remove_edge(self, u, v)
+        self._unindex_edge(u, v)
+
+    def remove_edges_from(self, ebunch):
+        ebunch = list(ebunch)
+        nx.DiGraph.remove_edges_from(self, ebunch)
+        for e in ebunch:
+            self._unindex_edge(e[0], e[1])
+
+    def remove_node(self, n):
+        if n in self:
+            incident_edges = [(u, n) for u in self.pred[n]] + [(n, v) for v in self.succ[n]]
+        else:
+            incident_edges = []
+        nx.DiGraph.remove_node(self, n)
+        self._problems.clear()
+        for u, v in incident_edges:
+            self._unindex_edge(u, v)
+
+    def remove_nodes_from(self, nodes):
+        for n in list(nodes):
+            if n in self:
+                self.remove_node(n)
+
+    def clear(self):
+        nx.DiGraph.clear(self)
+        self.heads.clear()
+        self.secondary_heads.clear()
+        self._problems.clear()
 
     def pathtoroot(self, child):
         path = []
-        newhead = self.head_of(self, child)
+        newhead = self.head_of(child)
         while newhead:
             path.append(newhead)
-            newhead = self.head_of(self, newhead)
+            newhead = self.head_of(newhead)
         return path
 
     def head_of(self, n):
-        for u, v in self.edges():
-            if v == n:
-                return u
-        return None
+        """Returns the primary head of n, or None if n has no incoming primary edge"""
+        return self.heads.get(n)
+
+    def secondary_heads_of(self, n):
+        return self.secondary_heads.get(n, set())
+
+    def problems(self, projective=False):
+        """Why the sentence is not a well-formed tree (see tree_problems); cached until the tree changes"""
+        if projective not in self._problems:
+            num_tokens = max(self.nodes()) if len(self) else 0
+            heads = [-1] + [self.heads.get(token_i, -1) if token_i in self.node else None for token_i in range(1, num_tokens + 1)]
+            self._problems[projective] = tree_problems(heads, projective)
+        return list(self._problems[projective])
+
+    def is_well_formed(self, projective=False):
+        return not self.problems(projective)
 
     def get_sentence_as_string(self,printid=False):
         out = []
@@ -61,8 +391,17 @@ class DependencyTree(nx.DiGraph):
                 out.append(self.node[token_i]['form'])
         return u" ".join(out)
 
+    def token_dict(self, token_i):
+        """The CoNLL fields of token_i, including its head and deprel"""
+        token_dict = dict(self.node[token_i])
+        head_i = self.head_of(token_i)
+        token_dict['head'] = head_i
+        token_dict['deprel'] = self[head_i][token_i]['deprel']
+        token_dict['id'] = token_i
+        return token_dict
+
     def subsumes(self, head, child):
-        if head in self.pathtoroot(self, child):
+        if head in self.pathtoroot(child):
             return True
 
     def remove_arabic_diacritics(self):
@@ -70,60 +409,61 @@ class DependencyTree(nx.DiGraph):
         # It is equivalent to an interative application of isri.norm(word,num=1)
         # i.e. we do not remove any hamza characters
 
-        re_short_vowels = re.compile(r'[\u064B-\u0652]')
         for n in self.nodes():
-            self.node[n]["form"] = re_short_vowels.sub('', self.node[n]["form"])
+            self.node[n]["form"] = ARABIC_FORMS.normalize(self.node[n]["form"])
+
+    def normalize_fields(self, normalizer):
+        """Applies a lib.normalize.Normalizer to the fields it covers"""
+        for n in self.nodes():
+            node = self.node[n]
+            for fieldname in normalizer.fields:
+                if fieldname in node:
+                    node[fieldname] = normalizer.normalize(node[fieldname])
 
 
     def get_highest_index_of_span(self, span):  # retrieves the node index that is closest to root
         #TODO: CANDIDATE FOR DEPRECATION
-        distancestoroot = [len(self.pathtoroot(self, x)) for x in span]
+        distancestoroot = [len(self.pathtoroot(x)) for x in span]
         shortestdistancetoroot = min(distancestoroot)
         spanhead = span[distancestoroot.index(shortestdistancetoroot)]
         return spanhead
 
     def get_deepest_index_of_span(self, span):  # retrieves the node index that is farthest from root
         #TODO: CANDIDATE FOR DEPRECATION
-        distancestoroot = [len(self.pathtoroot(self, x)) for x in span]
+        distancestoroot = [len(self.pathtoroot(x)) for x in span]
         longestdistancetoroot = max(distancestoroot)
         lownode = span[distancestoroot.index(longestdistancetoroot)]
         return lownode
 
     def span_makes_subtree(self, initidx, endidx):
-        G = nx.DiGraph()
-        span_nodes = list(range(initidx,endidx+1))
-        span_words = [self.node[x]["form"] for x in span_nodes]
-        G.add_nodes_from(span_nodes)
-        for h,d in self.edges():
-            if h in span_nodes and d in span_nodes:
-                G.add_edge(h,d)
-        return nx.is_tree(G)
+        # The edges among the span tokens form a tree iff there is one less of them than tokens
+        # and they connect all the tokens
+        span_nodes = set(range(initidx,endidx+1))
+        if not span_nodes:
+            return False
+        neighbours = {n: [] for n in span_nodes}
+        num_edges = 0
+        for d in span_nodes:
+            for h in self.pred.get(d, ()):
+                if h in span_nodes:
+                    neighbours[h].append(d)
+                    neighbours[d].append(h)
+                    num_edges += 1
+        if num_edges != len(span_nodes) - 1:
+            return False
+        reached = {initidx}
+        stack = [initidx]
+        while stack:
+            for m in neighbours[stack.pop()]:
+                if m not in reached:
+                    reached.add(m)
+                    stack.append(m)
+        return len(reached) == len(span_nodes)
 
-    def _choose_spanhead_from_heuristics(self,span_nodes,pos_precedence_list):
-        distancestoroot = [len(nx.ancestors(self,x)) for x in span_nodes]
-        shortestdistancetoroot = min(distancestoroot)
-        distance_counter = Counter(distancestoroot)
-
-        highest_nodes_in_span = []
-        # Heuristic Nr 1: If there is one single highest node in the span, it becomes the head
-        # N.B. no need for the subspan to be a tree if there is one single highest element
-        if distance_counter[shortestdistancetoroot] == 1:
-            spanhead = span_nodes[distancestoroot.index(shortestdistancetoroot)]
-            return spanhead
-
-        # Heuristic Nr 2: Choose by POS ranking the best head out of the highest nodes
-        for x in span_nodes:
-            if len(nx.ancestors(self,x)) == shortestdistancetoroot:
-                highest_nodes_in_span.append(x)
-
-        best_rank = len(pos_precedence_list) + 1
-        candidate_head = - 1
-        span_upos  = [self.node[x]["cpostag"]for x in highest_nodes_in_span]
-        for upos, idx in zip(span_upos,highest_nodes_in_span):
-            if pos_precedence_list.index(upos) < best_rank:
-                best_rank = pos_precedence_list.index(upos)
-                candidate_head = idx
-        return candidate_head
+    def _remove_features(self, names):
+        for n in self.nodes():
+            if "feats" in self.node[n]:
+                self.node[n]["feats"] = feats_of(self.node[n]["feats"]).without(names)
 
     def _remove_node_properties(self,fields):
         for n in sorted(self.nodes()):
@@ -142,88 +482,429 @@ class DependencyTree(nx.DiGraph):
         # Attach C-level tokens to A
         #Remove B-level tokens, which are the subtokens of the fused form della: de la
 
-        if self.graph["multi_tokens"] == {}:
+        multi_tokens = self.graph.get("multi_tokens", {})
+        if multi_tokens == {}:
             return
 
-        spanheads = []
-        spanhead_fused_token_dict = {}
-        # This double iteration is overkill, one could skip the spanhead identification
-        # but in this way we avoid modifying the tree as we read it
-        for fusedform_idx in sorted(self.graph["multi_tokens"]):
-            fusedform_start, fusedform_end = self.graph["multi_tokens"][fusedform_idx]["id"]
-            fuseform_span = list(range(fusedform_start,fusedform_end+1))
-            spanhead = self._choose_spanhead_from_heuristics(fuseform_span,posPreferenceDicts)
-            #if not spanhead:
-            #    spanhead = self._choose_spanhead_from_heuristics(fuseform_span,posPreferenceDicts)
-            spanheads.append(spanhead)
-            spanhead_fused_token_dict[spanhead] = fusedform_idx
-
-        bottom_up_order = [x for x in nx.topological_sort(self) if x in spanheads]
-        for spanhead in bottom_up_order:
-            fusedform_idx = spanhead_fused_token_dict[spanhead]
-            fusedform = self.graph["multi_tokens"][fusedform_idx]["form"]
-            fusedform_start, fusedform_end = self.graph["multi_tokens"][fusedform_idx]["id"]
-            fuseform_span = list(range(fusedform_start,fusedform_end+1))
-
-            if spanhead:
-                #Step 1: Replace form of head span (A)  with fusedtoken form  -- in this way we keep the lemma and features if any
-                self.node[spanhead]["form"] = fusedform
-                # 2-  Reattach C-level (external dependents) to A
-                #print(fuseform_span,spanhead)
-
-                internal_dependents = set(fuseform_span) - set([spanhead])
-                external_dependents = [nx.bfs_successors(self,x) for x in internal_dependents]
-                for depdict in external_dependents:
-                    for localhead in depdict:
-                        for ext_dep in depdict[localhead]:
-                            deprel = self[localhead][ext_dep]["deprel"]
-                            self.remove_edge(localhead,ext_dep)
-                            self.add_edge(spanhead,ext_dep,deprel=deprel)
-
-                #3- Remove B-level tokens
-                for int_dep in internal_dependents:
-                    self.remove_edge(self.head_of(int_dep),int_dep)
-                    self.remove_node(int_dep)
-
-        #4 reconstruct tree at the very end
-        new_index_dict = {}
-        for new_node_index, old_node_idex in enumerate(sorted(self.nodes())):
-            new_index_dict[old_node_idex] = new_node_index
-
-        T = DependencyTree() # Transfer DiGraph, to replace self
+        # The whole merge runs on the head array, see merge_fused_spans
+        num_tokens = max(self.nodes())
+        heads = [-1] + [self.heads.get(token_i, -1) for token_i in range(1, num_tokens + 1)]
+        cpostags = [None] + [self.node[token_i].get("cpostag") for token_i in range(1, num_tokens + 1)]
+        merged_heads, kept, new_ids, spanheads = renumber_fused_spans(heads, cpostags, multi_tokens, posPreferenceDicts)
 
-        for n in sorted(self.nodes()):
-            T.add_node(new_index_dict[n],self.node[n])
+        #Step 1: Replace form of head span (A)  with fusedtoken form  -- in this way we keep the lemma and features if any
+        for spanhead, fusedform_idx in spanheads.items():
+            self.node[spanhead]["form"] = multi_tokens[fusedform_idx]["form"]
 
+        # 2 - Collect the surviving nodes and edges under their new indices: C-level tokens
+        # now hang from A, B-level tokens are gone
+        nodes = [(new_ids[n], self.node[n]) for n in sorted(self.nodes()) if n < len(new_ids) and new_ids[n] is not None]
+        # The primary edge of a token follows new_heads even if it is flagged secondary, which it is
+        # when DEPS repeats the basic head; other secondary edges survive if their head does
+        primary_edges = []
+        secondary_edges = []
         for h, d in self.edges():
-            T.add_edge(new_index_dict[h],new_index_dict[d],deprel=self[h][d]["deprel"])
-        #4A Quick removal of edges and nodes
-        self.__init__()
+            if d >= len(new_ids) or new_ids[d] is None:
+                continue
+            if self.heads.get(d) == h:
+                primary_edges.append((merged_heads[new_ids[d]], new_ids[d], self[h][d]))
+            elif h < len(new_ids) and new_ids[h] is not None:
+                secondary_edges.append((new_ids[h], new_ids[d], self[h][d]))
+
+        #3 Renumber in place, keeping the node attribute dicts and the graph attributes
+        self.succ.clear()
+        self.pred.clear()
+        self.node.clear()
+        self.heads.clear()
+        self.secondary_heads.clear()
+        for n, attr in nodes:
+            self.add_node(n)
+            self.node[n] = attr
+        for h, d, attr in primary_edges:
+            self.add_edge(h, d, attr)
+            self.heads[d] = h
+        for h, d, attr in secondary_edges:
+            # a secondary edge from the new primary head would overwrite its deprel
+            if d not in self.succ[h]:
+                self.add_edge(h, d, attr)
+
+        # 4. remove all fused forms form the multi_tokens field
+        self.graph["multi_tokens"] = {}
+
+        report_not_a_tree(self, merged_heads)
+
+    def filter_sentence_content(self,replace_subtokens_with_fused_forms=False, lang=None, posPreferenceDict=None,node_properties_to_remove=None,remove_deprel_suffixes=False,remove_arabic_diacritics=False,normalizer=None,features_to_remove=None):
+        if replace_subtokens_with_fused_forms:
+            instrument.run_step("fused_forms", self._keep_fused_form, posPreferenceDict)
+        if remove_deprel_suffixes:
+            instrument.run_step("deprel_suffixes", self._remove_deprel_suffixes)
+        if node_properties_to_remove:
+            instrument.run_step("node_properties", self._remove_node_properties, node_properties_to_remove)
+        if remove_arabic_diacritics:
+            instrument.run_step("arabic_diacritics", self.remove_arabic_diacritics)
+        if normalizer is not None:
+            instrument.run_step("normalize", self.normalize_fields, normalizer)
+        if features_to_remove:
+            instrument.run_step("features", self._remove_features, features_to_remove)
+
+
+class CompactSentence(object):
+    """
+    A memory-light alternative to DependencyTree:
+    tokens are stored in parallel arrays indexed by token id (index 0 is the root),
+    heads in an int array and all string fields interned.
+    Offers the same reading and filtering API as DependencyTree and converts to one on demand.
+    """
+
+    __slots__ = ('heads', 'deprels', 'forms', 'lemmas', 'cpostags', 'postags', 'feats', 'misc', 'deps', 'graph')
+
+    FIELDS = (('form', 'forms'), ('lemma', 'lemmas'), ('cpostag', 'cpostags'), ('postag', 'postags'),
+              ('feats', 'feats'), ('misc', 'misc'))
+
+    def __init__(self):
+        self.heads = array('i', [-1])
+        self.deprels = ['_']
+        self.forms = ['ROOT']
+        self.lemmas = ['ROOT']
+        self.cpostags = ['ROOT']
+        self.postags = ['ROOT']
+        self.feats = ['_']
+        self.misc = ['_']
+        self.deps = {}  # secondary edges, only for the tokens that have them
+        self.graph = {'multi_tokens': {}}
+
+    def __len__(self):
+        return len(self.heads) - 1
+
+    def add_token(self, head, deprel, form, lemma, cpostag, postag, feats, misc, deps=None):
+        intern = sys.intern
+        self.heads.append(head)
+        self.deprels.append(intern(deprel))
+        self.forms.append(intern(form))
+        self.lemmas.append(intern(lemma))
+        self.cpostags.append(intern(cpostag))
+        self.postags.append(intern(postag))
+        self.feats.append(feats_of(feats))
+        self.misc.append(intern(misc))
+        if deps:
+            self.deps[len(self.heads) - 1] = deps
+
+    def nodes(self):
+        return list(range(len(self.heads)))
+
+    def head_of(self, n):
+        if 0 < n < len(self.heads):
+            return self.heads[n]
+        return None
+
+    def pathtoroot(self, child):
+        path = []
+        newhead = self.head_of(child)
+        while newhead:
+            path.append(newhead)
+            newhead = self.head_of(newhead)
+        return path
 
-        #4B Rewriting the Deptree in Self
-        # TODO There must a more elegant way to rewrite self -- self= T for instance?
-        for n in sorted(T.nodes()):
-            self.add_node(n,T.node[n])
+    def get_sentence_as_string(self,printid=False):
+        out = []
+        for token_i in range(1, len(self.heads)):
+            if printid:
+                out.append(str(token_i)+":"+self.forms[token_i])
+            else:
+                out.append(self.forms[token_i])
+        return u" ".join(out)
+
+    def token_dict(self, token_i):
+        token_dict = {key: getattr(self, column)[token_i] for key, column in self.FIELDS}
+        token_dict['head'] = self.heads[token_i]
+        token_dict['deprel'] = self.deprels[token_i]
+        token_dict['id'] = token_i
+        return token_dict
 
-        for h,d in T.edges():
-            self.add_edge(h,d,T[h][d])
+    def to_networkx(self):
+        """Returns the sentence as a DependencyTree, as read by CoNLLReader.read_conll_u"""
+        sent = DependencyTree()
+        for token_i in range(1, len(self.heads)):
+            sent.add_edge(self.heads[token_i], token_i, deprel=self.deprels[token_i])
+            sent.node[token_i].update({key: getattr(self, column)[token_i] for key, column in self.FIELDS})
+            for head, deprel in self.deps.get(token_i, []):
+                sent.add_edge(head, token_i, deprel=deprel, secondary=True)
+        if 0 in sent:
+            for key in ('form', 'lemma', 'cpostag', 'postag'):
+                sent.node[0][key] = 'ROOT'
+        sent.graph.update(self.graph)
+        return sent
 
-        # 5. remove all fused forms form the multi_tokens field
+    def is_tree(self):
+        return heads_form_tree(self.heads)
+
+    def problems(self, projective=False):
+        """Why the sentence is not a well-formed tree, see tree_problems"""
+        return tree_problems(self.heads, projective)
+
+    def is_well_formed(self, projective=False):
+        return not self.problems(projective)
+
+    def remove_arabic_diacritics(self):
+        self.forms = ARABIC_FORMS.normalize_column(self.forms)
+
+    def normalize_fields(self, normalizer):
+        """Applies a lib.normalize.Normalizer to the fields it covers"""
+        for key, column in self.FIELDS:
+            if key in normalizer.fields:
+                setattr(self, column, normalizer.normalize_column(getattr(self, column)))
+
+    def _remove_features(self, names):
+        self.feats = [feats_of(feats).without(names) for feats in self.feats]
+
+    def _remove_node_properties(self,fields):
+        for key, column in self.FIELDS:
+            if key in fields:
+                setattr(self, column, ['_'] * len(self.heads))
+
+    def _remove_deprel_suffixes(self):
+        self.deprels = [sys.intern(deprel.split(":")[0]) for deprel in self.deprels]
+
+    def _keep_fused_form(self,posPreferenceDicts):
+        multi_tokens = self.graph.get("multi_tokens", {})
+        if multi_tokens == {}:
+            return
+
+        merged_heads, kept, new_ids, spanheads = renumber_fused_spans(self.heads, self.cpostags, multi_tokens, posPreferenceDicts)
+        for spanhead, fusedform_idx in spanheads.items():
+            self.forms[spanhead] = sys.intern(multi_tokens[fusedform_idx]["form"])
+
+        self.heads = array('i', merged_heads)
+        for key, column in self.FIELDS + (('deprel', 'deprels'),):
+            values = getattr(self, column)
+            setattr(self, column, [values[old_id] for old_id in kept])
+        self.deps = {new_ids[d]: [(new_ids[h], deprel) for h, deprel in deps if new_ids[h] is not None]
+                     for d, deps in self.deps.items() if new_ids[d] is not None}
         self.graph["multi_tokens"] = {}
 
-        if not nx.is_tree(self):
-            print("Not a tree after fused-form heuristics:",self.get_sentence_as_string())
+        report_not_a_tree(self, merged_heads)
 
-    def filter_sentence_content(self,replace_subtokens_with_fused_forms=False, lang=None, posPreferenceDict=None,node_properties_to_remove=None,remove_deprel_suffixes=False,remove_arabic_diacritics=False):
+    def filter_sentence_content(self,replace_subtokens_with_fused_forms=False, lang=None, posPreferenceDict=None,node_properties_to_remove=None,remove_deprel_suffixes=False,remove_arabic_diacritics=False,normalizer=None,features_to_remove=None):
         if replace_subtokens_with_fused_forms:
-            self._keep_fused_form(posPreferenceDict)
+            instrument.run_step("fused_forms", self._keep_fused_form, posPreferenceDict)
         if remove_deprel_suffixes:
-            self._remove_deprel_suffixes()
+            instrument.run_step("deprel_suffixes", self._remove_deprel_suffixes)
         if node_properties_to_remove:
-            self._remove_node_properties(node_properties_to_remove)
+            instrument.run_step("node_properties", self._remove_node_properties, node_properties_to_remove)
         if remove_arabic_diacritics:
-            self.remove_arabic_diacritics()
+            instrument.run_step("arabic_diacritics", self.remove_arabic_diacritics)
+        if normalizer is not None:
+            instrument.run_step("normalize", self.normalize_fields, normalizer)
+        if features_to_remove:
+            instrument.run_step("features", self._remove_features, features_to_remove)
+
+
+
+class TreebankCache(object):
+    """
+    On-disk cache of parsed treebanks.
+    Entries are keyed by the path, size and modification time of the input file and its format,
+    with hash_content also by the md5 of its content. They hold the sentences in the columnar form
+    of SentenceEncoder, pickled in chunks of CHUNK_SENTENCES so that they can be streamed back.
+    When the cache grows beyond max_bytes, the least recently used entries are evicted.
+    """
+
+    # Bump whenever the readers change what they produce, to invalidate old entries
+    VERSION = 4
+    DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+    CHUNK_SENTENCES = 1000
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, hash_content=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hash_content = hash_content
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_environment(cls, cache_dir=None, disabled=False):
+        """The cache given by cache_dir or $UD_CONVERSION_CACHE, or None if neither is set or disabled;
+        entries are keyed by content as well if $UD_CONVERSION_CACHE_HASH is set"""
+        cache_dir = cache_dir or os.environ.get("UD_CONVERSION_CACHE")
+        if disabled or not cache_dir:
+            return None
+        return cls(cache_dir, hash_content=bool(os.environ.get("UD_CONVERSION_CACHE_HASH")))
+
+    def entry_path(self, filename, input_format):
+        stat = os.stat(filename)
+        key = hashlib.md5("{}\0{}\0{}".format(os.path.realpath(filename), stat.st_size, stat.st_mtime_ns).encode("utf-8"))
+        if self.hash_content:
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    key.update(block)
+        return os.path.join(self.cache_dir, "{}-{}-v{}.pickle".format(key.hexdigest(), input_format, self.VERSION))
+
+    def iter_treebank(self, filename, input_format, parse):
+        """Streams the sentences of filename from the cache, or from parse(filename) while filling the cache"""
+        path = self.entry_path(filename, input_format)
+        if os.path.exists(path):
+            if instrument.active is not None:
+                instrument.active.count("cache_hits")
+            os.utime(path)  # mark as recently used
+            with open(path, 'rb') as f:
+                while True:
+                    try:
+                        chunk = pickle.load(f)
+                    except EOFError:
+                        return
+                    for sent in decode_chunk(chunk):
+                        yield sent
+
+        if instrument.active is not None:
+            instrument.active.count("cache_misses")
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                chunk = SentenceEncoder()
+                for sent in parse(filename):
+                    # encoded before the caller gets to modify the sentence
+                    chunk.add(sent)
+                    if len(chunk.sentences) >= self.CHUNK_SENTENCES:
+                        pickle.dump(chunk.dump(), f, pickle.HIGHEST_PROTOCOL)
+                        chunk = SentenceEncoder()
+                    yield sent
+                if chunk.sentences:
+                    pickle.dump(chunk.dump(), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".pickle"):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+
+class LayoutIndex(dict):
+    """Tuple of field names -> index, numbering new layouts as they are looked up"""
+
+    def __missing__(self, layout):
+        self[layout] = len(self)
+        return self[layout]
+
+
+class SentenceEncoder(object):
+    """
+    The columnar form of a chunk of DependencyTrees kept by TreebankCache. The nodes of all sentences
+    are stored as a list of ids, a list of layouts (the tuple of field names of a node, by index) and
+    one flat list of field values; the edges as lists of heads, dependents and deprels, or attribute
+    dicts for edges with more than a deprel; the head index as lists of dependents and heads.
+    Per sentence only the counts, the secondary heads, the order of the heads of tokens with several
+    (which the edge order need not give back) and the graph attributes are kept.
+    Equal strings are replaced by one shared object, so pickle writes them once per chunk.
+    """
+
+    def __init__(self):
+        self.layouts = LayoutIndex()
+        self.ids = []
+        self.layout_ids = []
+        self.values = []
+        self.edge_heads = []
+        self.edge_dependents = []
+        self.edge_data = []
+        self.index_dependents = []
+        self.index_heads = []
+        self.sentences = []
+
+    def add(self, sent):
+        nodes = sent.node.values()
+        self.ids.extend(sent.node)
+        self.layout_ids.extend(map(self.layouts.__getitem__, map(tuple, nodes)))
+        self.values.extend(chain.from_iterable(map(dict.values, nodes)))
+
+        succ = sent.succ
+        num_edges = len(self.edge_data)
+        self.edge_heads.extend([u for u, dependents in succ.items() for v in dependents])
+        self.edge_dependents.extend([v for dependents in succ.values() for v in dependents])
+        self.edge_data.extend([datadict['deprel'] if len(datadict) == 1 and 'deprel' in datadict else dict(datadict)
+                               for dependents in succ.values() for datadict in dependents.values()])
+        num_edges = len(self.edge_data) - num_edges
+        self.index_dependents.extend(sent.heads)
+        self.index_heads.extend(sent.heads.values())
+        head_orders = {v: list(heads) for v, heads in sent.pred.items() if len(heads) > 1}
+        secondary_heads = {v: set(heads) for v, heads in sent.secondary_heads.items()}
+        self.sentences.append((len(sent.node), num_edges, len(sent.heads), secondary_heads, head_orders, graph_snapshot(sent.graph)))
+
+    def dump(self):
+        """What TreebankCache pickles for the chunk, read back by decode_chunk"""
+        layouts = [layout for layout, _ in sorted(self.layouts.items(), key=lambda item: item[1])]
+        shared = {}.setdefault
+        # plain strings only: a Feats equals its string, but is shared already
+        values = [shared(value, value) if value.__class__ is str else value for value in self.values]
+        edge_data = [shared(deprel, deprel) if deprel.__class__ is str else deprel for deprel in self.edge_data]
+        return (layouts, self.ids, self.layout_ids, values, self.edge_heads, self.edge_dependents, edge_data,
+                self.index_dependents, self.index_heads, self.sentences)
+
 
+def graph_snapshot(graph):
+    """A copy of the graph attributes of a sentence that later changes to the sentence do not reach"""
+    snapshot = {}
+    for key, value in graph.items():
+        if key == 'multi_tokens':
+            snapshot[key] = {token_i: dict(token_dict) for token_i, token_dict in value.items()}
+        elif key == 'comment':
+            snapshot[key] = list(value)
+        else:
+            snapshot[key] = copy.deepcopy(value)
+    return snapshot
+
+
+def decode_chunk(chunk):
+    """Yields the DependencyTrees of a chunk encoded by SentenceEncoder"""
+    layouts, ids, layout_ids, values, edge_heads, edge_dependents, edge_data, index_dependents, index_heads, sentences = chunk
+    node_layouts = map(layouts.__getitem__, layout_ids)
+    values = iter(values)
+    node_i = edge_i = index_i = 0
+    for num_nodes, num_edges, num_heads, secondary_heads, head_orders, graph in sentences:
+        sent = DependencyTree()
+        node_ids = ids[node_i:node_i + num_nodes]
+        # zip stops at the end of a layout, so every node takes its own values; no Python loop per node
+        sent.node.update(zip(node_ids, map(dict, map(zip, islice(node_layouts, num_nodes), repeat(values)))))
+        succ = sent.succ
+        pred = sent.pred
+        succ.update({n: {} for n in node_ids})
+        pred.update({n: {} for n in node_ids})
+        for u, v, datadict in zip(edge_heads[edge_i:edge_i + num_edges], edge_dependents[edge_i:edge_i + num_edges], edge_data[edge_i:edge_i + num_edges]):
+            if datadict.__class__ is not dict:
+                datadict = {'deprel': datadict}
+            succ[u][v] = datadict
+            pred[v][u] = datadict
+        sent.heads.update(zip(index_dependents[index_i:index_i + num_heads], index_heads[index_i:index_i + num_heads]))
+        sent.secondary_heads.update(secondary_heads)
+        for v, order in head_orders.items():
+            pred[v] = {u: pred[v][u] for u in order}
+        sent.graph.update(graph)
+        node_i += num_nodes
+        edge_i += num_edges
+        index_i += num_heads
+        yield sent
+
+
+def read_all(sentences):
+    """list(sentences) with the cyclic garbage collector paused. Parsed sentences hold no reference
+    cycles, but every collection would rescan the millions of dicts of a large treebank while the list
+    grows, which doubles the time to read one."""
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        return list(sentences)
+    finally:
+        if gc_enabled:
+            gc.enable()
 
 
 class CoNLLReader(object):
@@ -232,23 +913,34 @@ class CoNLLReader(object):
     """
 
     "" "Static properties"""
-    CONLL06_COLUMNS = [('id',int), ('form',str), ('lemma',str), ('cpostag',str), ('postag',str), ('feats',str), ('head',int), ('deprel',str), ('phead', str), ('pdeprel',str)]
+    CONLL06_COLUMNS = [('id',int), ('form',str), ('lemma',str), ('cpostag',str), ('postag',str), ('feats',feats_of), ('head',int), ('deprel',str), ('phead', str), ('pdeprel',str)]
     #CONLL06_COLUMNS = ['id', 'form', 'lemma', 'cpostag', 'postag', 'feats', 'head', 'deprel', 'phead', 'pdeprel']
-    CONLL06DENSE_COLUMNS = [('id',int), ('form',str), ('lemma',str), ('cpostag',str), ('postag',str), ('feats',str), ('head',int), ('deprel',str), ('edgew',str)]
+    CONLL06DENSE_COLUMNS = [('id',int), ('form',str), ('lemma',str), ('cpostag',str), ('postag',str), ('feats',feats_of), ('head',int), ('deprel',str), ('edgew',str)]
     CONLL_U_COLUMNS = [('id', parse_id), ('form', str), ('lemma', str), ('cpostag', str),
-                   ('postag', str), ('feats', str), ('head', parse_id), ('deprel', str),
+                   ('postag', str), ('feats', feats_of), ('head', parse_id), ('deprel', str),
                    ('deps', parse_deps), ('misc', str)]
     #CONLL09_COLUMNS =  ['id','form','lemma','plemma','cpostag','pcpostag','feats','pfeats','head','phead','deprel','pdeprel']
+    # first value of a .sentidx sidecar index, changes with its layout
+    INDEX_MAGIC = 0x53454e5449445801
 
 
 
-    def __init__(self):
-        pass
+    def __init__(self, cache=None):
+        # an optional TreebankCache used by iter_treebank
+        self.cache = cache
 
     def read_conll_2006(self, filename):
-        sentences = []
+        return read_all(self.iter_conll_2006(filename))
+
+    def iter_conll_2006(self, filename):
+        """Yields one DependencyTree per sentence, without keeping the treebank in memory"""
+        with open_input(filename) as conll_file:
+            for sent in self.iter_conll_2006_lines(conll_file, filename):
+                yield sent
+
+    def iter_conll_2006_lines(self, lines, filename=None):
         sent = DependencyTree()
-        for line_num, conll_line in enumerate(open(filename)):
+        for line_num, conll_line in enumerate(lines):
             parts = conll_line.strip().split("\t")
             if len(parts) in (8, 10):
                 token_dict = {key: conv_fn(val) for (key, conv_fn), val in zip(self.CONLL06_COLUMNS, parts)}
@@ -256,17 +948,22 @@ class CoNLLReader(object):
                 sent.add_node(token_dict['id'], token_dict)
                 sent.add_edge(token_dict['head'], token_dict['id'], deprel=token_dict['deprel'])
             elif len(parts) == 0  or (len(parts)==1 and parts[0]==""):
-                sentences.append(sent)
+                yield sent
                 sent = DependencyTree()
             else:
                 raise Exception("Invalid input format in line nr: ", line_num, conll_line, filename)
-     
-        return sentences
 
     def read_conll_2006_dense(self, filename):
-        sentences = []
+        return read_all(self.iter_conll_2006_dense(filename))
+
+    def iter_conll_2006_dense(self, filename):
+        with open_input(filename) as conll_file:
+            for sent in self.iter_conll_2006_dense_lines(conll_file, filename):
+                yield sent
+
+    def iter_conll_2006_dense_lines(self, lines, filename=None):
         sent = DependencyTree()
-        for conll_line in open(filename):
+        for conll_line in lines:
             parts = conll_line.strip().split("\t")
             if len(parts) == 9:
                 token_dict = {key: conv_fn(val) for (key, conv_fn), val in zip(self.CONLL06DENSE_COLUMNS, parts)}
@@ -274,56 +971,209 @@ class CoNLLReader(object):
                 sent.add_node(token_dict['id'], token_dict)
                 sent.add_edge(token_dict['head'], token_dict['id'], deprel=token_dict['deprel'])
             elif len(parts) == 0 or (len(parts)==1 and parts[0]==""):
-                sentences.append(sent)
+                yield sent
                 sent = DependencyTree()
             else:
                 raise Exception("Invalid input format in line: ", conll_line, filename)
 
+    def iter_treebank(self, filename, input_format="conllu"):
+        """Streams the sentences of filename in any of the supported input formats, through the cache if any"""
+        if self.cache is not None:
+            sentences = self.cache.iter_treebank(filename, input_format, lambda f: self._parse_treebank(f, input_format))
+        else:
+            sentences = self._parse_treebank(filename, input_format)
+        if instrument.active is not None:
+            return instrument.active.timed(sentences, "read")
         return sentences
 
+    def _parse_treebank(self, filename, input_format):
+        if input_format == "conllu":
+            return self.iter_conll_u(filename)
+        elif input_format == "conll2006":
+            return self.iter_conll_2006(filename)
+        elif input_format == "conll2006dense":
+            return self.iter_conll_2006_dense(filename)
+        raise ValueError("Unknown input format: {}".format(input_format))
 
+    def _parse_lines(self, lines, input_format):
+        if input_format == "conllu":
+            return self.iter_conll_u_lines(lines)
+        elif input_format == "conll2006":
+            return self.iter_conll_2006_lines(lines)
+        elif input_format == "conll2006dense":
+            return self.iter_conll_2006_dense_lines(lines)
+        raise ValueError("Unknown input format: {}".format(input_format))
 
-    def write_conll(self, list_of_graphs, conll_path,conllformat, print_fused_forms=False,print_comments=False):
-        # TODO add comment writing
+    def index_path(self, filename):
+        return str(filename) + ".sentidx"
+
+    def build_index(self, filename):
+        """Scans filename for sentence boundaries and stores their byte offsets in a sidecar file.
+        The index records the size and mtime of filename, and load_index rebuilds it when they change."""
+        offsets = self.sentence_offsets(filename)
+        stat = os.stat(filename)
+        index = array('q', [self.INDEX_MAGIC, stat.st_size, stat.st_mtime_ns])
+        for start, end in offsets:
+            index.append(start)
+            index.append(end)
+        try:
+            with open(self.index_path(filename), 'wb') as f:
+                index.tofile(f)
+        except OSError as e:
+            print("Could not write sentence index for {}: {}".format(filename, e), file=sys.stderr)
+        return offsets
+
+    def load_index(self, filename):
+        """The sentence offsets of filename, from its sidecar index if it is up to date"""
+        index_path = self.index_path(filename)
+        if os.path.exists(index_path):
+            stat = os.stat(filename)
+            index = array('q')
+            with open(index_path, 'rb') as f:
+                index.frombytes(f.read())
+            if len(index) >= 3 and list(index[:3]) == [self.INDEX_MAGIC, stat.st_size, stat.st_mtime_ns]:
+                return list(zip(index[3::2], index[4::2]))
+        return self.build_index(filename)
+
+    def get_sentences(self, filename, ids, input_format="conllu"):
+        """Parses only the sentences with the given indices (in the order given), using the sidecar index"""
+        offsets = self.load_index(filename)
+        sentences = []
+        if not ids:
+            return sentences
+        if input_compression(filename) is None:
+            with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                blocks = [mapped[offsets[i][0]:offsets[i][1]] for i in ids]
+        else:
+            # offsets refer to the decompressed stream; read the blocks in file order so seeks only go forward
+            blocks = {}
+            with open_input(filename, 'rb', prefetch=False) as f:
+                for i in sorted(set(ids)):
+                    f.seek(offsets[i][0])
+                    blocks[i] = f.read(offsets[i][1] - offsets[i][0])
+            blocks = [blocks[i] for i in ids]
+        for block in blocks:
+            sentences.extend(self._parse_lines(io.StringIO(block.decode("utf-8") + "\n"), input_format))
+        return sentences
+
+    def get_sentence(self, filename, i, input_format="conllu"):
+        return self.get_sentences(filename, [i], input_format)[0]
+
+    def sentence_offsets(self, filename):
+        """Byte offsets (start, end) of the lines of every sentence, found by a scan for blank lines without parsing"""
+        offsets = []
+        start = position = 0
+        with open_input(filename, 'rb') as conll_file:
+            for line in conll_file:
+                if not line.strip():
+                    offsets.append((start, position))
+                    start = position + len(line)
+                position += len(line)
+        return offsets
+
+    def iter_raw_chunks(self, filename, sentences_per_chunk):
+        """Splits a file at blank lines into lists of raw lines holding sentences_per_chunk sentences each"""
+        with open_input(filename) as conll_file:
+            yield from self.iter_raw_chunks_lines(conll_file, sentences_per_chunk)
+
+    def iter_raw_chunks_lines(self, lines, sentences_per_chunk):
+        chunk = []
+        num_sentences = 0
+        for line in lines:
+            chunk.append(line)
+            if not line.strip("\n"):
+                num_sentences += 1
+                if num_sentences == sentences_per_chunk:
+                    if instrument.active is not None:
+                        instrument.active.sentences_read(num_sentences)
+                    yield chunk
+                    chunk = []
+                    num_sentences = 0
+        # lines after the last blank line do not form a sentence, as in iter_conll_u
+        if num_sentences:
+            if instrument.active is not None:
+                instrument.active.sentences_read(num_sentences)
+            yield chunk
+
+    def _columns_for_format(self, conllformat):
         if conllformat == "conllu":
-            columns = [colname for colname, fname in self.CONLL_U_COLUMNS]
+            return [colname for colname, fname in self.CONLL_U_COLUMNS]
         else:
-            columns = [colname for colname, fname in self.CONLL06_COLUMNS]
-
-        with conll_path.open('w') as out:
-            for sent_i, sent in enumerate(list_of_graphs):
-                if sent_i > 0:
-                    print("", file=out)
-                if print_comments:
-                    for c in sent.graph["comment"]:
-                        print(c, file=out)
-                for token_i in range(1, max(sent.nodes()) + 1):
-                    token_dict = dict(sent.node[token_i])
-                    head_i = sent.head_of(token_i)
-                    token_dict['head'] = head_i
-                    # print(head_i, token_i)
-                    token_dict['deprel'] = sent[head_i][token_i]['deprel']
-                    token_dict['id'] = token_i
-                    row = [str(token_dict.get(col, '_')) for col in columns]
-                    if print_fused_forms and token_i in sent.graph["multi_tokens"]:
-                       currentmulti = sent.graph["multi_tokens"][token_i]
-                       currentmulti["id"]=str(currentmulti["id"][0])+"-"+str(currentmulti["id"][1])
-                       currentmulti["feats"]="_"
-                       currentmulti["head"]="_"
-                       rowmulti = [str(currentmulti.get(col, '_')) for col in columns]
-                       print(u"\t".join(rowmulti),file=out)
-                    print(u"\t".join(row), file=out)
-            
-            # emtpy line afterwards
-            print(u"", file=out)
+            return [colname for colname, fname in self.CONLL06_COLUMNS]
+
+    def write_conll(self, list_of_graphs, conll_path,conllformat, print_fused_forms=False,print_comments=False):
+        # list_of_graphs can be any iterable, e.g. the generators returned by iter_conll_u,
+        # in which case sentences are written as soon as they are produced.
+        # conll_path may end in .gz or .xz for compressed output, or be "-" for stdout
+        with CoNLLWriter.open(conll_path, conllformat, print_fused_forms, print_comments) as writer:
+            for sent in list_of_graphs:
+                writer.write(sent)
+
+    def write_conll_stream(self, sentences, out, conllformat, print_fused_forms=False, print_comments=False):
+        """Writes an iterable of sentences to an open file object, one sentence at a time"""
+        writer = CoNLLWriter(out, conllformat, print_fused_forms, print_comments, self)
+        for sent in sentences:
+            writer.write(sent)
+        writer.finish()
+
+    def write_numpy_bundle(self, sentences, bundle_path):
+        """Exports sentences as memory-mappable NumPy arrays, see lib/npbundle.py. Requires numpy."""
+        from lib.npbundle import write_numpy_bundle
+        return write_numpy_bundle(sentences, bundle_path)
+
+    def load_numpy_bundle(self, bundle_path):
+        from lib.npbundle import NumpyTreebank
+        return NumpyTreebank(bundle_path)
+
+    def render_sentence(self, sent, conllformat, print_fused_forms=False, print_comments=False):
+        """Returns the lines of sent in conllformat as a single string"""
+        return self._render_sentence(sent, self._columns_for_format(conllformat), print_fused_forms, print_comments)
+
+    def _render_sentence(self, sent, columns, print_fused_forms=False, print_comments=False):
+        lines = []
+        if print_comments:
+            lines.extend(sent.graph.get("comment", []))
+        multi_tokens = sent.graph.get("multi_tokens", {}) if print_fused_forms else {}
+        for token_i in range(1, max(sent.nodes()) + 1):
+            token_dict = sent.token_dict(token_i)
+            if token_i in multi_tokens:
+                # fused-form row, built on a copy so that the sentence can be written again
+                currentmulti = dict(multi_tokens[token_i])
+                currentmulti["id"] = str(currentmulti["id"][0])+"-"+str(currentmulti["id"][1])
+                currentmulti["feats"] = "_"
+                currentmulti["head"] = "_"
+                lines.append(u"\t".join([str(currentmulti.get(col, '_')) for col in columns]))
+            lines.append(u"\t".join([str(token_dict.get(col, '_')) for col in columns]))
+        lines.append(u"")
+        return u"\n".join(lines)
+
+    def _write_sentence(self, sent, out, columns, print_fused_forms=False, print_comments=False):
+        out.write(self._render_sentence(sent, columns, print_fused_forms, print_comments))
 
 
     def read_conll_u(self,filename,keepFusedForm=False, lang=None, posPreferenceDict=None):
-        sentences = []
+        return read_all(self.iter_conll_u(filename, keepFusedForm, lang, posPreferenceDict))
+
+    def iter_conll_u(self,filename,keepFusedForm=False, lang=None, posPreferenceDict=None):
+        """Yields one DependencyTree per sentence, reading the file line by line"""
+        with open_input(filename) as conll_file:
+            for sent in self.iter_conll_u_lines(conll_file):
+                yield sent
+
+    def iter_conll_u_lines(self, lines):
+        """Yields one DependencyTree per sentence from an iterable of CoNLL-U lines"""
+        # Fast path: tokens go straight into the networkx adjacency dicts and the head index,
+        # without intermediate token dicts, and the small vocabularies are interned so that
+        # all tokens share the same string objects. The result is the same as
+        #   sent.add_edge(head, id, deprel=deprel); sent.node[id].update(token fields)
+        intern = sys.intern
+        # the cache behind feats_of, looked up inline: most bundles have been seen before
+        feats_bundles = interned_bundles()
         sent = DependencyTree()
+        succ, pred, node, heads = sent.succ, sent.pred, sent.node, sent.heads
         multi_tokens = {}
 
-        for line_no, line in enumerate(open(filename).readlines()):
+        for line_no, line in enumerate(lines):
             line = line.strip("\n")
             if not line:
                 # Add extra properties to ROOT node if exists
@@ -334,28 +1184,267 @@ class CoNLLReader(object):
                 # Handle multi-tokens
                 sent.graph['multi_tokens'] = multi_tokens
                 multi_tokens = {}
-                sentences.append(sent)
+                yield sent
                 sent = DependencyTree()
-            elif line.startswith("#"):
+                succ, pred, node, heads = sent.succ, sent.pred, sent.node, sent.heads
+            elif line[0] == "#":
                 if 'comment' not in sent.graph:
                     sent.graph['comment'] = [line]
                 else:
                     sent.graph['comment'].append(line)
             else:
                 parts = line.split("\t")
-                if len(parts) != len(self.CONLL_U_COLUMNS):
-                    error_msg = 'Invalid number of columns in line {} (found {}, expected {})'.format(line_no, len(parts), len(CONLL_U_COLUMNS))
+                try:
+                    token_id, form, lemma, cpostag, postag, feats, head, deprel, deps, misc = parts
+                except ValueError:
+                    error_msg = 'Invalid number of columns in line {} (found {}, expected {})'.format(line_no, len(parts), len(self.CONLL_U_COLUMNS))
                     raise Exception(error_msg)
 
-                token_dict = {key: conv_fn(val) for (key, conv_fn), val in zip(self.CONLL_U_COLUMNS, parts)}
-                if isinstance(token_dict['id'], int):
-                    sent.add_edge(token_dict['head'], token_dict['id'], deprel=token_dict['deprel'])
-                    sent.node[token_dict['id']].update({k: v for (k, v) in token_dict.items()
-                                                        if k not in ('head', 'id', 'deprel', 'deps')})
-                    for head, deprel in token_dict['deps']:
-                        sent.add_edge(head, token_dict['id'], deprel=deprel, secondary=True)
+                if "-" in token_id:
+                    token_dict = {key: conv_fn(val) for (key, conv_fn), val in zip(self.CONLL_U_COLUMNS, parts)}
+                    multi_tokens[token_dict['id'][0]] = token_dict
+                    continue
+
+                token_i = int(token_id)
+                head = None if head == '_' else int(head)
+                feats_bundle = feats_bundles.get(feats)
+                if feats_bundle is None:
+                    feats_bundle = feats_of(feats)
+                if head not in succ:
+                    succ[head] = {}
+                    pred[head] = {}
+                    node[head] = {}
+                if token_i not in succ:
+                    succ[token_i] = {}
+                    pred[token_i] = {}
+                # every field is set, so this equals updating the dict of a token already seen as a head
+                node[token_i] = {'form': form, 'lemma': lemma, 'cpostag': intern(cpostag), 'postag': intern(postag),
+                                 'feats': feats_bundle, 'misc': misc}
+                datadict = {'deprel': intern(deprel)}
+                succ[head][token_i] = datadict
+                pred[token_i][head] = datadict
+                heads[token_i] = head
+
+                if deps != '_':
+                    for dep_head, dep_deprel in parse_deps(deps):
+                        sent.add_edge(dep_head, token_i, deprel=dep_deprel, secondary=True)
+
+    def iter_conll_u_compact(self, filename):
+        """Like iter_conll_u, but yields CompactSentence objects instead of networkx graphs"""
+        sent = CompactSentence()
+        multi_tokens = {}
+
+        with open_input(filename) as conll_file:
+            for line_no, line in enumerate(conll_file):
+                line = line.strip("\n")
+                if not line:
+                    sent.graph['multi_tokens'] = multi_tokens
+                    multi_tokens = {}
+                    yield sent
+                    sent = CompactSentence()
+                elif line.startswith("#"):
+                    sent.graph.setdefault('comment', []).append(line)
                 else:
-                    #print(token_dict['id'])
-                    first_token_id = int(token_dict['id'][0])
-                    multi_tokens[first_token_id] = token_dict
-        return sentences
+                    parts = line.split("\t")
+                    if len(parts) != len(self.CONLL_U_COLUMNS):
+                        error_msg = 'Invalid number of columns in line {} (found {}, expected {})'.format(line_no, len(parts), len(self.CONLL_U_COLUMNS))
+                        raise Exception(error_msg)
+
+                    token_id, form, lemma, cpostag, postag, feats, head, deprel, deps, misc = parts
+                    if "-" in token_id:
+                        token_dict = {key: conv_fn(val) for (key, conv_fn), val in zip(self.CONLL_U_COLUMNS, parts)}
+                        multi_tokens[token_dict['id'][0]] = token_dict
+                    else:
+                        if int(token_id) != len(sent) + 1:
+                            raise Exception('Token ids must be consecutive, line {}'.format(line_no))
+                        sent.add_token(int(head), deprel, form, lemma, cpostag, postag, feats, misc, parse_deps(deps))
+
+
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+def input_compression(path):
+    """"gzip", "xz", "zstd" or None, judged by the first bytes of the file rather than its name"""
+    with open(path, 'rb') as f:
+        magic = f.read(6)
+    if magic.startswith(GZIP_MAGIC):
+        return "gzip"
+    if magic.startswith(XZ_MAGIC):
+        return "xz"
+    if magic.startswith(ZSTD_MAGIC):
+        return "zstd"
+    return None
+
+
+class PrefetchingReader(io.RawIOBase):
+    """
+    Reads a (decompressing) binary stream in a background thread, so that decompression
+    overlaps with parsing in the main thread. At most max_blocks blocks are read ahead.
+    """
+
+    def __init__(self, raw, block_size=1 << 20, max_blocks=8):
+        io.RawIOBase.__init__(self)
+        self.raw = raw
+        self.block_size = block_size
+        self.blocks = queue.Queue(max_blocks)
+        self.stopped = threading.Event()
+        self.pending = memoryview(b"")
+        self.at_eof = False
+        self.thread = threading.Thread(target=self._prefetch, daemon=True)
+        self.thread.start()
+
+    def _prefetch(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.raw.read(self.block_size)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        # gives up when the reader is closed before consuming everything
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.pending:
+            if self.at_eof:
+                return 0
+            block = self.blocks.get()
+            if isinstance(block, Exception):
+                raise block
+            if not block:
+                self.at_eof = True
+                return 0
+            self.pending = memoryview(block)
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.raw.close()
+        io.RawIOBase.close(self)
+
+
+def open_input(path, mode='r', prefetch=True):
+    """Opens path for reading in text ('r') or binary ('rb') mode, decompressing gzip, xz or zstd
+    input transparently. xz and zstd are decompressed in a background thread unless prefetch is False,
+    which keeps the stream seekable."""
+    compression = input_compression(path)
+    if compression is None:
+        return open(path, mode)
+    if compression == "gzip":
+        raw = gzip.open(path, 'rb')
+    elif compression == "xz":
+        raw = lzma.open(path, 'rb')
+    else:
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception("Reading zstd-compressed input requires the zstandard package: {}".format(path))
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    if prefetch and compression in ("xz", "zstd"):
+        raw = io.BufferedReader(PrefetchingReader(raw))
+    if mode == 'rb':
+        return raw
+    return io.TextIOWrapper(raw)
+
+
+def open_output(path):
+    """Opens path for writing text: "-" is stdout, and paths ending in .gz or .xz are compressed"""
+    path = str(path)
+    if path == "-":
+        sys.stdout.flush()
+        return open(sys.stdout.fileno(), 'w', encoding=sys.stdout.encoding, closefd=False)
+    if path.endswith(".gz"):
+        return gzip.open(path, 'wt')
+    if path.endswith(".xz"):
+        return lzma.open(path, 'wt')
+    return open(path, 'w')
+
+def exit_on_broken_pipe():
+    """Ends a command-line tool whose stdout was closed early, e.g. piped into head, without a traceback"""
+    # stdout goes to devnull, so that flushing it at interpreter exit does not fail again
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+    sys.exit(1)
+
+
+class CoNLLWriter(object):
+    """
+    Writes sentences one at a time to an open file, with the same layout as CoNLLReader.write_conll.
+    Useful to keep several outputs open and route each sentence as soon as it is read.
+    Rendered sentences are collected and written out in blocks of about BUFFER_CHARS characters.
+    """
+
+    BUFFER_CHARS = 1 << 20
+
+    def __init__(self, out, conllformat, print_fused_forms=False, print_comments=False, cio=None):
+        self.out = out
+        self.cio = cio or CoNLLReader()
+        self.columns = self.cio._columns_for_format(conllformat)
+        self.print_fused_forms = print_fused_forms
+        self.print_comments = print_comments
+        self.num_sentences = 0
+        self.buffer = []
+        self.buffered_chars = 0
+
+    @classmethod
+    def open(cls, conll_path, conllformat, print_fused_forms=False, print_comments=False):
+        return cls(open_output(conll_path), conllformat, print_fused_forms, print_comments)
+
+    def write(self, sent):
+        self.write_rendered(instrument.run_step("render", self.cio._render_sentence, sent, self.columns, self.print_fused_forms, self.print_comments))
+
+    def write_rendered(self, rendered):
+        """Adds an already rendered sentence, e.g. one produced by a worker process"""
+        if self.num_sentences > 0:
+            self.buffer.append(u"\n")
+        self.buffer.append(rendered)
+        self.buffered_chars += len(rendered)
+        self.num_sentences += 1
+        if self.buffered_chars >= self.BUFFER_CHARS:
+            self.flush()
+
+    def flush(self):
+        instrument.run_step("output", self.out.write, u"".join(self.buffer))
+        self.buffer = []
+        self.buffered_chars = 0
+
+    def finish(self):
+        # emtpy line afterwards
+        self.buffer.append(u"\n")
+        self.flush()
+
+    def close(self):
+        self.finish()
+        self.out.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # the output is incomplete anyway, e.g. after a closed pipe: close it without writing the rest
+        self.buffer = []
+        try:
+            self.out.close()
+        except OSError:
+            pass
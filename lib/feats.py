@@ -0,0 +1,83 @@
+"""
+Morphological feature bundles (the FEATS column, e.g. Case=Nom|Number=Sing) as shared immutable strings.
+
+feats_of returns one Feats object per distinct bundle for the whole process, so a treebank with
+millions of tokens stores every bundle once and parses it at most once, and only when a feature is
+actually looked at. A Feats is the original string itself, so it is written back unchanged for free;
+changes such as without() produce another interned bundle in canonical UD order.
+"""
+
+# bundle string -> Feats, for the whole process; treebanks have a few thousand distinct bundles
+_BUNDLES = {}
+# bundle string -> tuple of (name, value) pairs, filled on first access
+_PARSED = {}
+
+
+class Feats(str):
+    """An immutable feature bundle; it equals and hashes like its string, and "_" is the empty bundle"""
+
+    __slots__ = ()
+
+    def __reduce__(self):
+        # unpickled bundles are shared like freshly read ones
+        return feats_of, (str(self),)
+
+    def items(self):
+        """The (name, value) pairs, in the order of the string"""
+        pairs = _PARSED.get(self)
+        if pairs is None:
+            if self == '_' or not self:
+                pairs = ()
+            else:
+                pairs = tuple(tuple(pair.partition("=")[::2]) for pair in self.split("|"))
+            _PARSED[str(self)] = pairs
+        return pairs
+
+    def names(self):
+        return [name for name, value in self.items()]
+
+    def get(self, name, default=None):
+        for featname, value in self.items():
+            if featname == name:
+                return value
+        return default
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def updated(self, changes):
+        """The bundle with the features in changes set to new values, or removed where the value is None"""
+        features = self.as_dict()
+        for name, value in changes.items():
+            if value is None:
+                features.pop(name, None)
+            else:
+                features[name] = value
+        return feats_from_dict(features)
+
+    def without(self, names):
+        """The bundle without the given feature names; self if none of them occurs"""
+        if not any(name in names for name, value in self.items()):
+            return self
+        return feats_from_dict({name: value for name, value in self.items() if name not in names})
+
+
+def feats_of(feats_str):
+    """The shared Feats object for feats_str"""
+    feats = _BUNDLES.get(feats_str)
+    if feats is None:
+        feats = _BUNDLES[feats_str] = Feats(feats_str)
+    return feats
+
+
+def interned_bundles():
+    """The bundle string -> Feats mapping behind feats_of, for readers that look most bundles up inline;
+    it is only read, new bundles still go through feats_of"""
+    return _BUNDLES
+
+
+def feats_from_dict(features):
+    """A shared Feats object from a name -> value dict, with names in UD order (case-insensitive alphabetical)"""
+    if not features:
+        return feats_of('_')
+    return feats_of("|".join(name + "=" + features[name] for name in sorted(features, key=str.lower)))
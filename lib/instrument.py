@@ -0,0 +1,131 @@
+"""
+Opt-in instrumentation for long conversions: progress with sentences/sec on stderr, cumulative
+per-stage timers and counters, an optional cProfile dump and a JSON summary at exit.
+
+Nothing is measured until enable() is called; until then instrumented code only checks that
+`active` is None.
+"""
+from collections import Counter, defaultdict
+import atexit
+import cProfile
+import json
+import sys
+import time
+
+active = None
+
+
+class Instrumentation(object):
+
+    # "Not a tree" sentences and similar events are counted, but only the first ones are kept
+    MAX_EVENTS = 20
+
+    def __init__(self, progress_interval=None, out=sys.stderr):
+        self.progress_interval = progress_interval
+        self.out = out
+        self.started = time.perf_counter()
+        self.next_progress = self.started + progress_interval if progress_interval else None
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self.counters = Counter()
+        self.events = defaultdict(list)
+        # time spent in stages called from within the running call(), which is not counted for it
+        self.nested_seconds = 0.0
+
+    def add_time(self, stage, seconds):
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+
+    def call(self, stage, function, *args):
+        """function(*args), timed as stage; the time of stages it calls in turn is only counted for those"""
+        outer_nested = self.nested_seconds
+        self.nested_seconds = 0.0
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add_time(stage, elapsed - self.nested_seconds)
+            self.nested_seconds = outer_nested + elapsed
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def event(self, name, detail):
+        """Records that the current sentence triggered e.g. the "not a tree" path"""
+        self.counters[name] += 1
+        if len(self.events[name]) < self.MAX_EVENTS:
+            self.events[name].append({"sentence": self.counters["sentences"], "detail": detail})
+
+    def sentences_read(self, n=1):
+        self.counters["sentences"] += n
+        if self.next_progress is not None:
+            now = time.perf_counter()
+            if now >= self.next_progress:
+                self.next_progress = now + self.progress_interval
+                print("{} sentences, {:.1f} sentences/sec".format(self.counters["sentences"], self.counters["sentences"] / (now - self.started)), file=self.out)
+
+    def timed(self, sentences, stage="read"):
+        """Passes sentences through, timing each step of the iteration as stage and counting them"""
+        sentences = iter(sentences)
+        while True:
+            start = time.perf_counter()
+            try:
+                sent = next(sentences)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            self.sentences_read()
+            yield sent
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        return {"elapsed_seconds": round(elapsed, 6),
+                "sentences": self.counters["sentences"],
+                "sentences_per_sec": round(self.counters["sentences"] / elapsed, 1) if elapsed else None,
+                "stages": {stage: {"seconds": round(seconds, 6), "calls": self.calls[stage]} for stage, seconds in sorted(self.seconds.items())},
+                "counters": dict(self.counters),
+                "events": dict(self.events)}
+
+
+def run_step(stage, function, *args):
+    """function(*args), timed as stage when instrumentation is enabled"""
+    if active is None:
+        return function(*args)
+    return active.call(stage, function, *args)
+
+
+def enable(progress_interval=None, summary_path=None, profile_path=None):
+    """Turns instrumentation on for the rest of the process; the summary and profile are written at exit"""
+    global active
+    active = Instrumentation(progress_interval)
+    profiler = None
+    if profile_path:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    atexit.register(_finish, active, summary_path, profiler, profile_path)
+    return active
+
+
+def _finish(instrumentation, summary_path, profiler, profile_path):
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile_path)
+    if summary_path == "-":
+        print(json.dumps(instrumentation.summary(), indent=1), file=sys.stderr)
+    elif summary_path:
+        with open(summary_path, 'w') as f:
+            json.dump(instrumentation.summary(), f, indent=1)
+
+
+def add_instrumentation_arguments(parser):
+    parser.add_argument('--progress', help="report progress to stderr every SECONDS (default 10)", metavar='SECONDS', type=float, nargs='?', const=10.0)
+    parser.add_argument('--stats', help="write a JSON summary of per-stage timings and counters at exit, - for stderr", metavar='FILE')
+    parser.add_argument('--profile', help="write cProfile statistics of the whole run, readable with pstats", metavar='FILE')
+
+
+def enable_from_args(args):
+    if args.progress or args.stats or args.profile:
+        return enable(args.progress, args.stats, args.profile)
+    return None
@@ -0,0 +1,74 @@
+"""
+Character normalization of token fields: removal of the vowel marks of a script and Unicode
+normalization, through str.translate tables built once and a cache of already normalized values.
+"""
+import sys
+import unicodedata
+
+# Combining marks removed per script
+SCRIPT_MARKS = {
+    # Arabic harakat (fathatan to sukun), as in nltk.stem.isri; hamza is kept
+    "arabic": list(range(0x064B, 0x0653)),
+    # Hebrew niqqud: points sheva to meteg, rafe, shin/sin dots, upper/lower dots and qamats qatan
+    "hebrew": list(range(0x05B0, 0x05BE)) + [0x05BF, 0x05C1, 0x05C2, 0x05C4, 0x05C5, 0x05C7],
+}
+
+UNICODE_FORMS = ('NFC', 'NFKC', 'NFD', 'NFKD')
+
+
+class Normalizer(object):
+    """
+    Normalizes the given fields of every token: first the marks of the scripts in strip are removed,
+    then the result is brought to unicode_form (e.g. NFC), if any.
+    Normalized values are interned and cached, so a repeated form costs one dict lookup.
+    """
+
+    # stage name of the instrumentation timers, as in filter_sentence_content
+    stage = "normalize"
+
+    # The cache is emptied when it reaches this many entries
+    MAX_CACHE_ENTRIES = 1 << 18
+
+    def __init__(self, fields=('form',), strip=(), unicode_form=None):
+        for script in strip:
+            if script not in SCRIPT_MARKS:
+                raise ValueError("Unknown script: {}, expected one of {}".format(script, ", ".join(sorted(SCRIPT_MARKS))))
+        if unicode_form is not None and unicode_form not in UNICODE_FORMS:
+            raise ValueError("Unknown Unicode normalization form: {}".format(unicode_form))
+        self.fields = tuple(fields)
+        self.strip = tuple(strip)
+        self.unicode_form = unicode_form
+        self.table = {codepoint: None for script in strip for codepoint in SCRIPT_MARKS[script]}
+        self.cache = {}
+
+    def normalize(self, value):
+        normalized = self.cache.get(value)
+        if normalized is None:
+            normalized = value.translate(self.table) if self.table else value
+            if self.unicode_form is not None:
+                normalized = unicodedata.normalize(self.unicode_form, normalized)
+            normalized = sys.intern(normalized)
+            if len(self.cache) >= self.MAX_CACHE_ENTRIES:
+                self.cache.clear()
+            self.cache[value] = normalized
+        return normalized
+
+    def normalize_column(self, values):
+        """A whole column of a sentence or batch at once"""
+        normalize = self.normalize
+        return [normalize(value) for value in values]
+
+    def __call__(self, token_dict):
+        # as a token step of lib.pipeline.SentencePipeline
+        for fieldname in self.fields:
+            if fieldname in token_dict:
+                token_dict[fieldname] = self.normalize(token_dict[fieldname])
+
+    def __getstate__(self):
+        # the cache is not worth sending to worker processes
+        state = dict(self.__dict__)
+        state['cache'] = {}
+        return state
+
+
+ARABIC_FORMS = Normalizer(('form',), ('arabic',))
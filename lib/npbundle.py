@@ -0,0 +1,87 @@
+"""
+Columnar NumPy export of treebanks, for parser training pipelines that want integer arrays
+instead of re-parsing CoNLL text.
+
+A bundle is a directory with one .npy file per column plus the vocabularies:
+    offsets.npy   int64, sentence i spans tokens offsets[i]:offsets[i+1]
+    heads.npy     int32, head index of every token (0 is the root, NO_HEAD for a token without head, '_' in the file)
+    form.npy, lemma.npy, cpostag.npy, deprel.npy   int32 vocabulary ids
+    vocab.json    {column: [string of id 0, string of id 1, ...]}
+Plain .npy files (unlike .npz) can be memory-mapped, so several processes share one copy on disk.
+"""
+from array import array
+from pathlib import Path
+import json
+
+import numpy as np
+
+VOCAB_COLUMNS = ('form', 'lemma', 'cpostag', 'deprel')
+# heads.npy value of tokens whose head is None
+NO_HEAD = -1
+
+
+def write_numpy_bundle(sentences, path):
+    """Encodes an iterable of DependencyTree or CompactSentence objects into a bundle directory"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+
+    vocabs = {col: {} for col in VOCAB_COLUMNS}
+    offsets = array('q', [0])
+    heads = array('i')
+    columns = {col: array('i') for col in VOCAB_COLUMNS}
+    num_sentences = 0
+    for sent in sentences:
+        # a token without head hangs from a None node, which is not a token
+        num_tokens = max((n for n in sent.nodes() if n is not None), default=0)
+        for token_i in range(1, num_tokens + 1):
+            token_dict = sent.token_dict(token_i)
+            head = token_dict['head']
+            heads.append(NO_HEAD if head is None else head)
+            for col in VOCAB_COLUMNS:
+                vocab = vocabs[col]
+                value = token_dict.get(col, '_')
+                if value not in vocab:
+                    vocab[value] = len(vocab)
+                columns[col].append(vocab[value])
+        offsets.append(len(heads))
+        num_sentences += 1
+
+    np.save(str(path / 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+    np.save(str(path / 'heads.npy'), np.array(heads, dtype=np.int32))
+    for col in VOCAB_COLUMNS:
+        np.save(str(path / (col + '.npy')), np.array(columns[col], dtype=np.int32))
+    with (path / 'vocab.json').open('w') as f:
+        json.dump({col: sorted(vocabs[col], key=vocabs[col].get) for col in VOCAB_COLUMNS}, f, ensure_ascii=False)
+    return num_sentences
+
+
+class NumpyTreebank(object):
+    """
+    Read access to a bundle written by write_numpy_bundle.
+    Arrays are memory-mapped, and treebank[i] returns zero-copy slices for sentence i.
+    """
+
+    def __init__(self, path, mmap_mode='r'):
+        path = Path(path)
+        self.offsets = np.load(str(path / 'offsets.npy'), mmap_mode=mmap_mode)
+        self.heads = np.load(str(path / 'heads.npy'), mmap_mode=mmap_mode)
+        self.columns = {col: np.load(str(path / (col + '.npy')), mmap_mode=mmap_mode) for col in VOCAB_COLUMNS}
+        with (path / 'vocab.json').open() as f:
+            self.vocab = json.load(f)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if not -len(self) <= i < len(self):
+            raise IndexError("sentence index out of range: {}".format(i))
+        i %= len(self)
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        sentence = {col: values[start:end] for col, values in self.columns.items()}
+        sentence['heads'] = self.heads[start:end]
+        return sentence
+
+    def decode(self, col, ids):
+        """Maps vocabulary ids of column col back to strings"""
+        vocab = self.vocab[col]
+        return [vocab[i] for i in ids]
@@ -0,0 +1,180 @@
+from lib import instrument
+from lib.conll import renumber_fused_spans, report_not_a_tree
+from lib.feats import feats_of
+from lib.normalize import ARABIC_FORMS
+
+
+class RemoveNodeProperties(object):
+    """Shows the given node properties as "_" """
+
+    stage = "node_properties"
+
+    def __init__(self, fields):
+        self.fields = fields
+
+    def __call__(self, token_dict):
+        for fieldname in self.fields:
+            if fieldname in token_dict:
+                token_dict[fieldname] = "_"
+
+
+class RemoveDeprelSuffixes(object):
+    """Shows e.g. nmod:tmod as nmod"""
+
+    stage = "deprel_suffixes"
+
+    def __call__(self, token_dict):
+        if ":" in token_dict['deprel']:
+            token_dict['deprel'] = token_dict['deprel'].split(":")[0]
+
+
+class RemoveArabicDiacritics(object):
+    """Strips Arabic short vowels from the form, see DependencyTree.remove_arabic_diacritics"""
+
+    stage = "arabic_diacritics"
+
+    def __call__(self, token_dict):
+        token_dict['form'] = ARABIC_FORMS.normalize(token_dict['form'])
+
+
+class RemoveFeatures(object):
+    """Drops the given features from the feats bundle"""
+
+    stage = "features"
+
+    def __init__(self, names):
+        self.names = frozenset(names)
+
+    def __call__(self, token_dict):
+        if 'feats' in token_dict:
+            token_dict['feats'] = feats_of(token_dict['feats']).without(self.names)
+
+
+class TimedStep(object):
+    """A token step whose calls are timed as a stage of their own, named by the step's stage attribute"""
+
+    def __init__(self, step):
+        self.step = step
+        self.stage = getattr(step, "stage", type(step).__name__)
+
+    def __call__(self, token_dict):
+        instrument.run_step(self.stage, self.step, token_dict)
+
+
+class SentenceView(object):
+    """
+    Read-only view of a sentence with the token projections of a SentencePipeline applied on access.
+    Offers what the writers need (nodes, token_dict, graph, head_of), so it can be written like a sentence.
+    """
+
+    def __init__(self, sent, token_steps):
+        self.sent = sent
+        self.token_steps = token_steps
+        self.graph = sent.graph
+
+    def nodes(self):
+        return self.sent.nodes()
+
+    def _base_token_dict(self, token_i):
+        return self.sent.token_dict(token_i)
+
+    def token_dict(self, token_i):
+        token_dict = self._base_token_dict(token_i)
+        for step in self.token_steps:
+            step(token_dict)
+        return token_dict
+
+    def head_of(self, token_i):
+        return self.token_dict(token_i)['head'] if token_i else None
+
+    def get_sentence_as_string(self,printid=False):
+        out = []
+        for token_i in range(1, max(self.nodes()) + 1):
+            if printid:
+                out.append(str(token_i)+":"+self.token_dict(token_i)['form'])
+            else:
+                out.append(self.token_dict(token_i)['form'])
+        return u" ".join(out)
+
+
+class FusedFormView(SentenceView):
+    """
+    A SentenceView in which every multiword-token span is collapsed onto its span head, as
+    DependencyTree._keep_fused_form does, but computed as an id mapping instead of rebuilding the graph.
+    """
+
+    def __init__(self, sent, token_steps, pos_precedence_list):
+        SentenceView.__init__(self, sent, token_steps)
+        multi_tokens = sent.graph.get("multi_tokens", {})
+        num_tokens = max(sent.nodes())
+        heads = [-1]
+        cpostags = [None]
+        for token_i in range(1, num_tokens + 1):
+            token_dict = sent.token_dict(token_i)
+            heads.append(token_dict['head'] if token_dict['head'] is not None else -1)
+            cpostags.append(token_dict.get('cpostag'))
+        self.heads, self.kept, new_ids, spanheads = renumber_fused_spans(heads, cpostags, multi_tokens, pos_precedence_list)
+        self.fused_forms = {spanhead: multi_tokens[fusedform_idx]["form"] for spanhead, fusedform_idx in spanheads.items()}
+        self.graph = dict(sent.graph)
+        self.graph["multi_tokens"] = {}
+
+        report_not_a_tree(self, self.heads)
+
+    def nodes(self):
+        return list(range(len(self.kept)))
+
+    def _base_token_dict(self, token_i):
+        old_id = self.kept[token_i]
+        token_dict = self.sent.token_dict(old_id)
+        token_dict['id'] = token_i
+        token_dict['head'] = self.heads[token_i]
+        if old_id in self.fused_forms:
+            token_dict['form'] = self.fused_forms[old_id]
+        return token_dict
+
+
+class SentencePipeline(object):
+    """
+    The transformations of filter_sentence_content as a composable pipeline of views:
+    sentences are never modified, and each step is only applied when a token is read, e.g. at write time.
+    """
+
+    def __init__(self, pos_precedence_list=None, token_steps=()):
+        # pos_precedence_list is set when multiword tokens are to be replaced by their fused forms
+        self.pos_precedence_list = pos_precedence_list
+        self.token_steps = list(token_steps)
+
+    @classmethod
+    def from_filter_args(cls, replace_subtokens_with_fused_forms=False, lang=None, posPreferenceDict=None,node_properties_to_remove=None,remove_deprel_suffixes=False,remove_arabic_diacritics=False,normalizer=None,features_to_remove=None):
+        """The pipeline equivalent to filter_sentence_content called with the same arguments"""
+        token_steps = []
+        if remove_deprel_suffixes:
+            token_steps.append(RemoveDeprelSuffixes())
+        if node_properties_to_remove:
+            token_steps.append(RemoveNodeProperties(node_properties_to_remove))
+        if remove_arabic_diacritics:
+            token_steps.append(RemoveArabicDiacritics())
+        if normalizer is not None:
+            token_steps.append(normalizer)
+        if features_to_remove:
+            token_steps.append(RemoveFeatures(features_to_remove))
+        return cls(posPreferenceDict if replace_subtokens_with_fused_forms else None, token_steps)
+
+    def then(self, step):
+        """A new pipeline with step applied to every token dict after the current steps"""
+        return SentencePipeline(self.pos_precedence_list, self.token_steps + [step])
+
+    def view(self, sent, token_steps=None):
+        if token_steps is None:
+            token_steps = self.token_steps
+        if self.pos_precedence_list is not None and sent.graph.get("multi_tokens"):
+            return instrument.run_step("fused_forms", FusedFormView, sent, token_steps, self.pos_precedence_list)
+        return SentenceView(sent, token_steps)
+
+    def __call__(self, sentences):
+        token_steps = self.token_steps
+        # the steps run lazily inside the writer's render stage, so each one gets its own timer
+        if instrument.active is not None:
+            token_steps = [TimedStep(step) for step in token_steps]
+        for sent in sentences:
+            yield self.view(sent, token_steps)
@@ -0,0 +1,151 @@
+"""
+Declarative tree rewrites, e.g. language-specific annotation fixes.
+
+A rule is a dict with a "match" part and one or more actions:
+    {"match": {"cpostag": "PROPN", "deprel": "case"}, "set": {"cpostag": "ADP", "feats": "_"}}
+    {"match": {"deprel": "mwe", "cpostag": "DET", "head_cpostag": "PROPN"}, "set": {"deprel": "det"}}
+    {"match": {"deprel": ["nmod:tmod", "nmod:poss"]}, "strip_deprel_subtype": true}
+Match keys are token fields (form, lemma, cpostag, postag, feats, deprel; upos and xpos are accepted
+for cpostag and postag) and the same fields of the head prefixed with head_. A match value is a string
+or a list of alternatives, and a rule without match applies to every token. "set" assigns token
+fields or the deprel of the token's edge to its head, "strip_deprel_subtype" cuts the deprel at ":".
+
+RewriteEngine compiles the rules into dispatch tables indexed by form, cpostag and deprel, so each
+token is only tested against the rules that can match it, and applies all of them in one pass per
+sentence. Rules are tried in the order given, and heads are visited before their dependents, so
+head_ conditions see the head with all rules applied.
+"""
+import json
+
+FIELD_ALIASES = {'upos': 'cpostag', 'xpos': 'postag'}
+TOKEN_FIELDS = ('form', 'lemma', 'cpostag', 'postag', 'feats', 'deprel')
+# Rules are indexed by the first of these fields they match on
+INDEXED_FIELDS = ('form', 'cpostag', 'deprel')
+
+
+def _field_name(key):
+    if key.startswith('head_'):
+        return 'head_' + FIELD_ALIASES.get(key[5:], key[5:])
+    return FIELD_ALIASES.get(key, key)
+
+
+class RewriteRule(object):
+
+    def __init__(self, rule):
+        self.match = {}
+        for key, value in rule.get('match', {}).items():
+            fieldname = _field_name(key)
+            if fieldname.replace('head_', '', 1) not in TOKEN_FIELDS:
+                raise ValueError("Unknown field in rule match: {}".format(key))
+            self.match[fieldname] = frozenset([value] if isinstance(value, str) else value)
+        self.set = {_field_name(key): value for key, value in rule.get('set', {}).items()}
+        for fieldname in self.set:
+            if fieldname not in TOKEN_FIELDS:
+                raise ValueError("Unknown field in rule set: {}".format(fieldname))
+        self.strip_deprel_subtype = rule.get('strip_deprel_subtype', False)
+        if not self.set and not self.strip_deprel_subtype:
+            raise ValueError("Rule without action: {}".format(rule))
+        self.index_field = next((fieldname for fieldname in INDEXED_FIELDS if fieldname in self.match), None)
+
+    def matches(self, sent, token_i, head_i):
+        for fieldname, values in self.match.items():
+            if fieldname.startswith('head_'):
+                if _token_value(sent, head_i, sent.head_of(head_i), fieldname[5:]) not in values:
+                    return False
+            elif _token_value(sent, token_i, head_i, fieldname) not in values:
+                return False
+        return True
+
+    def apply(self, sent, token_i, head_i):
+        """Rewrites the token; returns the names of the fields that changed"""
+        changed = []
+        for fieldname, value in self.set.items():
+            if _token_value(sent, token_i, head_i, fieldname) != value:
+                _set_token_value(sent, token_i, head_i, fieldname, value)
+                changed.append(fieldname)
+        if self.strip_deprel_subtype:
+            deprel = sent[head_i][token_i]['deprel']
+            if ":" in deprel:
+                sent[head_i][token_i]['deprel'] = deprel.split(":")[0]
+                changed.append('deprel')
+        return changed
+
+
+def _token_value(sent, token_i, head_i, fieldname):
+    if fieldname == 'deprel':
+        return sent[head_i][token_i]['deprel'] if head_i is not None else None
+    return sent.node[token_i].get(fieldname) if token_i is not None else None
+
+
+def _set_token_value(sent, token_i, head_i, fieldname, value):
+    if fieldname == 'deprel':
+        sent[head_i][token_i]['deprel'] = value
+    else:
+        sent.node[token_i][fieldname] = value
+
+
+class RewriteEngine(object):
+    """Applies a list of rewrite rules (see the module docstring) to DependencyTree sentences"""
+
+    def __init__(self, rules):
+        self.rules = [RewriteRule(rule) for rule in rules]
+        # index field -> value -> rule positions, in rule order
+        self.tables = {fieldname: {} for fieldname in INDEXED_FIELDS}
+        self.unindexed = []
+        for rule_i, rule in enumerate(self.rules):
+            if rule.index_field is None:
+                self.unindexed.append(rule_i)
+            else:
+                for value in rule.match[rule.index_field]:
+                    self.tables[rule.index_field].setdefault(value, []).append(rule_i)
+
+    @classmethod
+    def from_json(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def _candidates(self, sent, token_i, head_i, after=-1):
+        candidates = [rule_i for rule_i in self.unindexed if rule_i > after]
+        for fieldname, table in self.tables.items():
+            for rule_i in table.get(_token_value(sent, token_i, head_i, fieldname), ()):
+                if rule_i > after:
+                    candidates.append(rule_i)
+        candidates.sort()
+        return candidates
+
+    def rewrite_token(self, sent, token_i):
+        head_i = sent.head_of(token_i)
+        candidates = self._candidates(sent, token_i, head_i)
+        k = 0
+        while k < len(candidates):
+            rule_i = candidates[k]
+            rule = self.rules[rule_i]
+            if rule.matches(sent, token_i, head_i):
+                changed = rule.apply(sent, token_i, head_i)
+                if any(fieldname in INDEXED_FIELDS for fieldname in changed):
+                    # other rules may match the token now
+                    candidates = self._candidates(sent, token_i, head_i, rule_i)
+                    k = 0
+                    continue
+            k += 1
+
+    def apply(self, sent):
+        """Rewrites sent in place, visiting heads before their dependents; returns sent"""
+        visited = set()
+        stack = [0]
+        while stack:
+            head_i = stack.pop()
+            for token_i in sorted(sent.succ.get(head_i, ())):
+                if sent.head_of(token_i) == head_i and token_i not in visited:
+                    visited.add(token_i)
+                    self.rewrite_token(sent, token_i)
+                    stack.append(token_i)
+        # tokens that cannot be reached from the root, e.g. on a cycle
+        for token_i in sorted(sent.nodes()):
+            if token_i != 0 and token_i not in visited and sent.head_of(token_i) is not None:
+                self.rewrite_token(sent, token_i)
+        return sent
+
+    def __call__(self, sentences):
+        for sent in sentences:
+            yield self.apply(sent)
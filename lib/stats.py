@@ -0,0 +1,152 @@
+"""
+Treebank statistics, accumulated sentence by sentence in Counters, so that they can be computed in
+one streaming pass and partial results (e.g. of parallel chunks) can be merged.
+"""
+from collections import Counter
+
+from lib.conll import heads_form_tree, renumber_fused_spans, tree_problems
+
+DISTRIBUTIONS = ('upos', 'deprel', 'deprel_subtypes', 'sentence_lengths')
+
+
+def _preorder(children, right_to_left=False):
+    """order[n]: the step at which a depth-first walk from the root visits n"""
+    order = [0] * len(children)
+    step = 0
+    stack = [0]
+    while stack:
+        n = stack.pop()
+        order[n] = step
+        step += 1
+        stack.extend(children[n] if right_to_left else reversed(children[n]))
+    return order
+
+
+def _nearest_smaller(values):
+    """The nearest positions left and right of every position that hold a smaller value, -1 and len(values) if there are none"""
+    left = [-1] * len(values)
+    right = [len(values)] * len(values)
+    stack = []
+    for i, value in enumerate(values):
+        while stack and values[stack[-1]] > value:
+            right[stack.pop()] = i
+        if stack:
+            left[i] = stack[-1]
+        stack.append(i)
+    return left, right
+
+
+def nonprojective_arcs(heads):
+    """Number of arcs h -> d with a token between h and d that h does not dominate; heads must form a tree, O(n)"""
+    children = [[] for _ in heads]
+    for token_i in range(1, len(heads)):
+        children[heads[token_i]].append(token_i)
+    # k is not dominated by h iff a depth-first walk reaches k before h when visiting children left to right,
+    # or when visiting them right to left: ancestors come first in both walks, descendants after, the others
+    # first in exactly one. So the nearest tokens around h that h does not dominate are the nearest ones with
+    # a smaller number in either walk, and h -> d is non-projective iff one of them lies between h and d.
+    left, right = _nearest_smaller(_preorder(children))
+    left_rtl, right_rtl = _nearest_smaller(_preorder(children, right_to_left=True))
+    num_arcs = 0
+    for token_i in range(1, len(heads)):
+        head = heads[token_i]
+        if token_i < head:
+            if token_i < max(left[head], left_rtl[head]):
+                num_arcs += 1
+        elif token_i > min(right[head], right_rtl[head]):
+            num_arcs += 1
+    return num_arcs
+
+
+class TreebankStats(object):
+    """
+    Counts of a treebank: add() one sentence at a time, merge() partial results, to_dict() for JSON.
+    With pos_ranks (see lib.conll.pos_ranks) the sentences that are not trees after fused-form
+    merging are counted as well.
+    """
+
+    def __init__(self, pos_ranks=None):
+        self.pos_ranks = pos_ranks
+        self.counts = Counter()
+        self.distributions = {name: Counter() for name in DISTRIBUTIONS}
+
+    def add(self, sent):
+        counts = self.counts
+        token_ids = set(sent.nodes())
+        num_tokens = max(token_ids) if token_ids else 0
+        # heads[i] is None for a token id that does not occur, as in tree_problems
+        heads = [-1]
+        cpostags = [None]
+        upos = self.distributions['upos']
+        deprels = self.distributions['deprel']
+        subtypes = self.distributions['deprel_subtypes']
+        for token_i in range(1, num_tokens + 1):
+            if token_i not in token_ids:
+                heads.append(None)
+                cpostags.append(None)
+                continue
+            token_dict = sent.token_dict(token_i)
+            heads.append(token_dict['head'] if token_dict['head'] is not None else -1)
+            cpostags.append(token_dict['cpostag'])
+            upos[token_dict['cpostag']] += 1
+            deprel = token_dict['deprel']
+            deprels[deprel] += 1
+            if ":" in deprel:
+                subtypes[deprel] += 1
+        counts['sentences'] += 1
+        counts['tokens'] += len(token_ids) - 1 if token_ids else 0
+        self.distributions['sentence_lengths'][len(token_ids) - 1 if token_ids else 0] += 1
+
+        multi_tokens = sent.graph.get('multi_tokens', {})
+        counts['multiword_tokens'] += len(multi_tokens)
+        counts['tokens_in_multiword_tokens'] += sum(mwt['id'][1] - mwt['id'][0] + 1 for mwt in multi_tokens.values())
+
+        if not tree_problems(heads):
+            num_nonprojective = nonprojective_arcs(heads)
+            counts['nonprojective_arcs'] += num_nonprojective
+            counts['nonprojective_sentences'] += 1 if num_nonprojective else 0
+        else:
+            counts['malformed_sentences'] += 1
+
+        if self.pos_ranks is not None and multi_tokens:
+            # the check of _keep_fused_form, without changing the sentence; missing ids get the
+            # invalid head -1 there, and malformed input is counted in malformed_sentences already
+            heads_with_ids = [-1 if head is None else head for head in heads]
+            if not heads_form_tree(renumber_fused_spans(heads_with_ids, cpostags, multi_tokens, self.pos_ranks)[0]):
+                counts['not_a_tree_after_fused_forms'] += 1
+
+    def add_all(self, sentences):
+        for sent in sentences:
+            self.add(sent)
+        return self
+
+    def merge(self, other):
+        """Adds the counts of other, e.g. the result for another chunk of the treebank"""
+        self.counts.update(other.counts)
+        for name in DISTRIBUTIONS:
+            self.distributions[name].update(other.distributions[name])
+        return self
+
+    def to_dict(self):
+        counts = self.counts
+        result = {name: counts[name] for name in ('sentences', 'tokens', 'multiword_tokens', 'tokens_in_multiword_tokens',
+                                                  'malformed_sentences', 'nonprojective_arcs', 'nonprojective_sentences')}
+        if self.pos_ranks is not None:
+            result['not_a_tree_after_fused_forms'] = counts['not_a_tree_after_fused_forms']
+        result['multiword_token_rate'] = counts['tokens_in_multiword_tokens'] / counts['tokens'] if counts['tokens'] else 0.0
+        result['tokens_per_sentence'] = counts['tokens'] / counts['sentences'] if counts['sentences'] else 0.0
+        for name in DISTRIBUTIONS:
+            result[name] = {str(key): value for key, value in self.distributions[name].most_common()}
+        return result
+
+    @classmethod
+    def from_dict(cls, result):
+        """Reads back to_dict output, so that JSON results of separate runs can be merged"""
+        stats = cls()
+        for name in ('sentences', 'tokens', 'multiword_tokens', 'tokens_in_multiword_tokens', 'malformed_sentences',
+                     'nonprojective_arcs', 'nonprojective_sentences', 'not_a_tree_after_fused_forms'):
+            stats.counts[name] = result.get(name, 0)
+        for name in DISTRIBUTIONS:
+            stats.distributions[name] = Counter(result.get(name, {}))
+        stats.distributions['sentence_lengths'] = Counter({int(length): value for length, value in result.get('sentence_lengths', {}).items()})
+        return stats
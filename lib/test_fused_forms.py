@@ -0,0 +1,132 @@
+"""
+Regression tests for fused-form merging (--replace_subtokens_with_fused_forms).
+
+The files in example/expected were written by the baseline implementation (nx.topological_sort and
+bfs_successors over the graph); every way of merging has to reproduce them. The one intended difference
+from the baseline, a DEPS edge into a merged span, is checked separately in SecondaryEdgeIntoSpanTest.
+Run from the repository root with: python -m unittest lib.test_fused_forms
+"""
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+from lib.conll import CoNLLReader, pos_ranks
+from lib.pipeline import SentencePipeline
+
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "example")
+
+CASES = [("italian_sample", "it"), ("italian_sample", "default"),
+         ("enhanced_deps_sample", "it"), ("enhanced_deps_sample", "es")]
+
+
+def render(cio, sentences):
+    out = io.StringIO()
+    cio.write_conll_stream(sentences, out, "conll2006")
+    return out.getvalue()
+
+
+def merged_in_place(sentences, lang):
+    for sent in sentences:
+        sent.filter_sentence_content(True, lang, pos_ranks(lang))
+        yield sent
+
+
+class FusedFormRegressionTest(unittest.TestCase):
+
+    def expected(self, name, lang):
+        with open(os.path.join(EXAMPLE_DIR, "expected", "{}.fused_{}.conll".format(name, lang))) as f:
+            return f.read()
+
+    def check_all_cases(self, convert):
+        cio = CoNLLReader()
+        for name, lang in CASES:
+            with self.subTest(name=name, lang=lang), contextlib.redirect_stderr(io.StringIO()):
+                self.assertEqual(convert(cio, os.path.join(EXAMPLE_DIR, name + ".conllu"), lang), self.expected(name, lang))
+
+    def test_dependency_tree(self):
+        self.check_all_cases(lambda cio, path, lang: render(cio, merged_in_place(cio.iter_conll_u(path), lang)))
+
+    def test_compact_sentence(self):
+        self.check_all_cases(lambda cio, path, lang: render(cio, merged_in_place(cio.iter_conll_u_compact(path), lang)))
+
+    def test_pipeline_view(self):
+        def convert(cio, path, lang):
+            pipeline = SentencePipeline.from_filter_args(replace_subtokens_with_fused_forms=True, lang=lang, posPreferenceDict=pos_ranks(lang))
+            return render(cio, pipeline(cio.iter_conll_u(path)))
+        self.check_all_cases(convert)
+
+    def test_deps_repeating_the_basic_head(self):
+        # DEPS repeats the primary edge, so it is read as a single edge flagged secondary
+        lines = ["1-2\tab\t_\t_\t_\t_\t_\t_\t_\t_\n",
+                 "1\ta\ta\tVERB\t_\t_\t0\troot\t0:root\t_\n",
+                 "2\tb\tb\tNOUN\t_\t_\t1\tobj\t1:obj\t_\n",
+                 "3\tc\tc\tADJ\t_\t_\t2\tamod\t2:amod\t_\n",
+                 "\n"]
+        cio = CoNLLReader()
+        sent = next(cio.iter_conll_u_lines(lines))
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            sent.filter_sentence_content(True, None, pos_ranks("default"))
+        self.assertEqual(sent.heads, {1: 0, 2: 1})
+        self.assertEqual(sent[1][2]["deprel"], "amod")
+        self.assertEqual(stderr.getvalue(), "")
+        self.assertEqual(render(cio, [sent]), "1\tab\ta\tVERB\t_\t_\t0\troot\t_\t_\n2\tc\tc\tADJ\t_\t_\t1\tamod\t_\t_\n\n")
+
+
+class SecondaryEdgeIntoSpanTest(unittest.TestCase):
+    """
+    "cade" has the basic head 5 (conj) and the DEPS edge 3:dep from inside the fused span "della".
+    The baseline moved the DEPS edge to the merged token next to the basic one, reported "Not a tree"
+    and wrote whichever incoming edge networkx listed first: 3 dep. The HEAD column is kept instead.
+    """
+
+    LINES = ["1\tLa\til\tDET\t_\t_\t2\tdet\t2:det\t_\n",
+             "2\tcasa\tcasa\tNOUN\t_\t_\t5\tnsubj\t5:nsubj\t_\n",
+             "3-4\tdella\t_\t_\t_\t_\t_\t_\t_\t_\n",
+             "3\tdi\tdi\tADP\t_\t_\t4\tcase\t4:case\t_\n",
+             "4\tla\til\tDET\t_\t_\t6\tdet\t6:det\t_\n",
+             "5\tcrolla\tcrollare\tVERB\t_\t_\t0\troot\t0:root\t_\n",
+             "6\tnonna\tnonna\tNOUN\t_\t_\t2\tnmod\t2:nmod:di\t_\n",
+             "7\tcade\tcadere\tVERB\t_\t_\t5\tconj\t5:conj|3:dep\t_\n",
+             "\n"]
+
+    EXPECTED = ("1\tLa\til\tDET\t_\t_\t2\tdet\t_\t_\n"
+                "2\tcasa\tcasa\tNOUN\t_\t_\t4\tnsubj\t_\t_\n"
+                "3\tdella\til\tDET\t_\t_\t5\tdet\t_\t_\n"
+                "4\tcrolla\tcrollare\tVERB\t_\t_\t0\troot\t_\t_\n"
+                "5\tnonna\tnonna\tNOUN\t_\t_\t2\tnmod\t_\t_\n"
+                "6\tcade\tcadere\tVERB\t_\t_\t4\tconj\t_\t_\n\n")
+
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".conllu")
+        with os.fdopen(handle, "w") as f:
+            f.writelines(self.LINES)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def check(self, convert):
+        cio = CoNLLReader()
+        for lang in ("it", "es"):
+            stderr = io.StringIO()
+            with self.subTest(lang=lang), contextlib.redirect_stderr(stderr):
+                self.assertEqual(convert(cio, self.path, lang), self.EXPECTED)
+                self.assertEqual(stderr.getvalue(), "")
+
+    def test_dependency_tree(self):
+        self.check(lambda cio, path, lang: render(cio, merged_in_place(cio.iter_conll_u(path), lang)))
+
+    def test_compact_sentence(self):
+        self.check(lambda cio, path, lang: render(cio, merged_in_place(cio.iter_conll_u_compact(path), lang)))
+
+    def test_pipeline_view(self):
+        def convert(cio, path, lang):
+            pipeline = SentencePipeline.from_filter_args(replace_subtokens_with_fused_forms=True, lang=lang, posPreferenceDict=pos_ranks(lang))
+            return render(cio, pipeline(cio.iter_conll_u(path)))
+        self.check(convert)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,72 @@
+"""
+Tests for conllu_to_conll.py --validate: every malformed sentence is reported in one pass, left out of
+the output, and the run exits with status 1, serially and with --jobs.
+Run from the repository root with: python -m unittest lib.test_validate
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+MALFORMED = """# sent_id = ok
+1\ta\ta\tVERB\t_\t_\t0\troot\t_\t_
+2\tb\tb\tNOUN\t_\t_\t1\tobj\t_\t_
+
+# sent_id = gap
+1\ta\ta\tVERB\t_\t_\t0\troot\t_\t_
+3\tc\tc\tNOUN\t_\t_\t1\tobj\t_\t_
+
+# sent_id = cycle
+1\ta\ta\tVERB\t_\t_\t0\troot\t_\t_
+2\tb\tb\tNOUN\t_\t_\t3\tobj\t_\t_
+3\tc\tc\tNOUN\t_\t_\t2\tnmod\t_\t_
+
+# sent_id = roots
+1\ta\ta\tVERB\t_\t_\t0\troot\t_\t_
+2\tb\tb\tVERB\t_\t_\t0\troot\t_\t_
+
+# sent_id = last
+1\td\td\tVERB\t_\t_\t0\troot\t_\t_
+
+"""
+
+EXPECTED_OUTPUT = "1\ta\ta\tVERB\t_\t_\t0\troot\t_\t_\n2\tb\tb\tNOUN\t_\t_\t1\tobj\t_\t_\n\n1\td\td\tVERB\t_\t_\t0\troot\t_\t_\n\n"
+
+
+class ValidateTest(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.input = tempfile.mkstemp(suffix=".conllu")
+        with os.fdopen(handle, "w") as f:
+            f.write(MALFORMED)
+
+    def tearDown(self):
+        os.remove(self.input)
+
+    def convert(self, *options):
+        return subprocess.run([sys.executable, "conllu_to_conll.py", self.input, "-", "--validate"] + list(options),
+                              cwd=REPO_DIR, capture_output=True, text=True)
+
+    def check_run(self, result):
+        self.assertEqual(result.returncode, 1, result.stderr)
+        self.assertEqual(result.stdout, EXPECTED_OUTPUT)
+        reports = result.stderr.splitlines()
+        self.assertEqual(len(reports), 4, result.stderr)
+        self.assertIn("sentence 2 (# sent_id = gap): token ids not contiguous, missing: 2", reports[0])
+        self.assertIn("sentence 3 (# sent_id = cycle): cycle: 2, 3", reports[1])
+        self.assertIn("sentence 4 (# sent_id = roots): 2 tokens attached to the root: 1, 2", reports[2])
+        self.assertEqual(reports[3], "3 malformed sentences")
+
+    def test_serial(self):
+        self.check_run(self.convert())
+
+    def test_jobs(self):
+        # chunks of 2 sentences, so the reports come from different workers
+        self.check_run(self.convert("--jobs", "2", "--chunk_size", "2"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,54 +1,115 @@
+from itertools import count, islice
 from pathlib import Path
 import argparse
 import sys
 import random
 
-from lib.conll import CoNLLReader
-
-def main():
-    parser = argparse.ArgumentParser(description="""Sample k trees from a dependency tree file (w/o replacement)""")
-    parser.add_argument('input', help="conllu file")
-    parser.add_argument('output', help="target file", type=Path)
-    parser.add_argument('--input-format', choices=['conll2006', 'conll2006dense', 'conllu'], default="conllu")
-
-    parser.add_argument('--k',default=None,help="randomly sample k instances from file", type=int, required=True)
-    parser.add_argument('--ignore-first-n',default=0,help="ignore first n sentences in the file", type=int, required=False)
-    parser.add_argument('--seed',default=None,help="seed to use")
-    parser.add_argument('--ignore-warning', help="if k > size, ignore warning and select all", default=False, action="store_true")
-
-    args = parser.parse_args()
-
-    cio = CoNLLReader()
-    if args.input_format == "conllu":
-        orig_treebank = cio.read_conll_u(args.input)
-    elif args.input_format == "conll2006":
-        orig_treebank = cio.read_conll_2006(args.input)
-    elif args.input_format == "conll2006dense":
-        orig_treebank = cio.read_conll_2006_dense(args.input)
-    num_trees = len(orig_treebank)
-
-    if args.seed:
-        random.seed(args.seed)
-    print("Loaded treebank {} with {} sentences".format(args.input,num_trees), file=sys.stderr)
+from lib.conll import CoNLLReader, TreebankCache, open_input
 
+def check_sample_size(args, num_trees):
     if args.k > num_trees:
         if args.ignore_warning:
             print("ignore-warning={}".format(args.ignore_warning),file=sys.stderr)
         else:
             print("k cannot be larger than {} trees. abort. ".format(num_trees))
             exit()
-    if args.ignore_first_n >= max(num_trees-args.k,num_trees):
-        print("--ignore-first-n cannot be larger than {} trees. abort. ".format(max(num_trees-args.k,num_trees)))
+
+def check_ignore_first_n(args, num_trees):
+    if args.ignore_first_n >= num_trees:
+        print("--ignore-first-n must be smaller than the {} trees in the file. abort. ".format(num_trees))
         exit()
-        
     if args.ignore_first_n:
         print("ignoring first {} trees in file".format(args.ignore_first_n), file=sys.stderr)
-        orig_treebank = orig_treebank[args.ignore_first_n+1:]
+
+def skip_first_n(args, trees):
+    """trees without the first --ignore-first-n ones, which no mode samples from"""
+    return islice(trees, args.ignore_first_n, None)
+
+def sample_shuffle(cio, args):
+    orig_treebank = list(cio.iter_treebank(args.input, args.input_format))
+    num_trees = len(orig_treebank)
+
+    if args.seed:
+        random.seed(args.seed)
+    print("Loaded treebank {} with {} sentences".format(args.input,num_trees), file=sys.stderr)
+
+    check_ignore_first_n(args, num_trees)
+    check_sample_size(args, num_trees - args.ignore_first_n)
+    orig_treebank = list(skip_first_n(args, orig_treebank))
 
     random.shuffle(orig_treebank)
     sample = orig_treebank[0:args.k]
     print("sampled {} trees. seed: {}".format(len(sample), args.seed))
     cio.write_conll(sample, args.output, "conll2006")
 
+def sample_reservoir(cio, args):
+    # Algorithm R over the sentences after the first n; the sample is written in file order
+    rng = random.Random(args.seed)
+    reservoir = []
+    # zip takes the next tree before the next index, so after the pass the counter is at the number of trees
+    counter = count()
+    for tree, i in skip_first_n(args, zip(cio.iter_treebank(args.input, args.input_format), counter)):
+        seen = i - args.ignore_first_n
+        if seen < args.k:
+            reservoir.append((i, tree))
+        else:
+            j = rng.randint(0, seen)
+            if j < args.k:
+                reservoir[j] = (i, tree)
+
+    num_trees = next(counter)
+    print("Read treebank {} with {} sentences".format(args.input,num_trees), file=sys.stderr)
+    check_ignore_first_n(args, num_trees)
+    check_sample_size(args, num_trees - args.ignore_first_n)
+    sample = [tree for i, tree in sorted(reservoir, key=lambda x: x[0])]
+    print("sampled {} trees. seed: {}".format(len(sample), args.seed))
+    cio.write_conll(sample, args.output, "conll2006")
+
+def sample_offsets(cio, args):
+    # Only the byte offsets of the sentences are needed, from the sidecar index; the sampled ones are copied verbatim
+    rng = random.Random(args.seed)
+    offsets = cio.load_index(args.input)
+    num_trees = len(offsets)
+    print("Indexed treebank {} with {} sentences".format(args.input,num_trees), file=sys.stderr)
+    check_ignore_first_n(args, num_trees)
+    check_sample_size(args, num_trees - args.ignore_first_n)
+
+    candidates = list(skip_first_n(args, range(num_trees)))
+    chosen = sorted(rng.sample(candidates, min(args.k, len(candidates))))
+    with open_input(args.input, 'rb', prefetch=False) as conll_file, args.output.open('wb') as out:
+        blocks = []
+        for i in chosen:
+            start, end = offsets[i]
+            conll_file.seek(start)
+            blocks.append(conll_file.read(end - start))
+        out.write(b"\n".join(blocks) + b"\n")
+    print("sampled {} trees. seed: {}".format(len(chosen), args.seed))
+
+def main():
+    parser = argparse.ArgumentParser(description="""Sample k trees from a dependency tree file (w/o replacement)""")
+    parser.add_argument('input', help="conllu file, optionally gzip/xz/zstd compressed")
+    parser.add_argument('output', help="target file", type=Path)
+    parser.add_argument('--input-format', choices=['conll2006', 'conll2006dense', 'conllu'], default="conllu")
+    parser.add_argument('--cache-dir', help="cache parsed treebanks in this directory (default: $UD_CONVERSION_CACHE if set)")
+    parser.add_argument('--no-cache', help="do not use the parsed-treebank cache", default=False, action="store_true")
+
+    parser.add_argument('--k',default=None,help="randomly sample k instances from file", type=int, required=True)
+    parser.add_argument('--ignore-first-n',default=0,help="ignore first n sentences in the file", type=int, required=False)
+    parser.add_argument('--seed',default=None,help="seed to use")
+    parser.add_argument('--ignore-warning', help="if k > size, ignore warning and select all", default=False, action="store_true")
+    parser.add_argument('--mode', choices=['shuffle', 'reservoir', 'offsets'], default="shuffle",
+                        help="shuffle: load and shuffle the whole treebank; reservoir: one streaming pass in constant memory; "
+                             "offsets: copy the raw text of the sampled sentences from their byte offsets, without parsing (output keeps the input format)")
+
+    args = parser.parse_args()
+
+    cio = CoNLLReader(TreebankCache.from_environment(args.cache_dir, args.no_cache))
+    if args.mode == "reservoir":
+        sample_reservoir(cio, args)
+    elif args.mode == "offsets":
+        sample_offsets(cio, args)
+    else:
+        sample_shuffle(cio, args)
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,68 @@
+from collections import deque
+import argparse
+import json
+import multiprocessing
+
+from lib.conll import CoNLLReader, TreebankCache, exit_on_broken_pipe, load_pos_precedence_profiles, open_output, pos_ranks
+from lib.stats import TreebankStats
+from lib.instrument import add_instrumentation_arguments, enable_from_args
+
+def chunk_stats(lines, input_format, ranks):
+    """Counts one chunk of sentences; runs in the worker processes of --jobs"""
+    return TreebankStats(ranks).add_all(CoNLLReader()._parse_lines(lines, input_format))
+
+def treebank_stats(cio, filename, args, ranks):
+    if args.jobs <= 1:
+        return TreebankStats(ranks).add_all(cio.iter_treebank(filename, args.input_format))
+
+    # Partial counts are merged as the chunks finish in file order; at most 2 * jobs chunks are in flight
+    stats = TreebankStats(ranks)
+    pending = deque()
+    with multiprocessing.Pool(args.jobs) as pool:
+        for chunk in cio.iter_raw_chunks(filename, args.chunk_size):
+            pending.append(pool.apply_async(chunk_stats, (chunk, args.input_format, ranks)))
+            if len(pending) >= 2 * args.jobs:
+                stats.merge(pending.popleft().get())
+        while pending:
+            stats.merge(pending.popleft().get())
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="""Count sentences, tokens, multiword tokens, UPOS, deprels and
+                                     non-projective arcs of treebanks in one streaming pass, as JSON""")
+    parser.add_argument('input', help="treebank files, optionally gzip/xz/zstd compressed; the counts are summed", nargs='+')
+    parser.add_argument('--output', help="JSON target file, stdout by default", default="-")
+    parser.add_argument('--input-format', choices=['conll2006', 'conll2006dense', 'conllu'], default="conllu")
+    parser.add_argument('--lang', help="language 2-letter code for the POS precedence of fused-form merging", default="default")
+    parser.add_argument('--pos_profiles', help="JSON file with additional POS precedence lists per language code")
+    parser.add_argument('--merge', help="the inputs are JSON results of earlier runs, to be added up", default=False, action="store_true")
+    parser.add_argument('--jobs', help="number of worker processes; sentences are counted in parallel if > 1", type=int, default=1)
+    parser.add_argument('--chunk_size', help="sentences per work unit with --jobs", type=int, default=500)
+    parser.add_argument('--cache-dir', help="cache parsed treebanks in this directory (default: $UD_CONVERSION_CACHE if set); not used with --jobs")
+    parser.add_argument('--no-cache', help="do not use the parsed-treebank cache", default=False, action="store_true")
+    add_instrumentation_arguments(parser)
+    args = parser.parse_args()
+    enable_from_args(args)
+
+    if args.pos_profiles:
+        load_pos_precedence_profiles(args.pos_profiles)
+
+    stats = TreebankStats(pos_ranks(args.lang))
+    if args.merge:
+        for filename in args.input:
+            with open(filename) as f:
+                stats.merge(TreebankStats.from_dict(json.load(f)))
+    else:
+        cio = CoNLLReader(TreebankCache.from_environment(args.cache_dir, args.no_cache))
+        for filename in args.input:
+            stats.merge(treebank_stats(cio, filename, args, stats.pos_ranks))
+
+    with open_output(args.output) as out:
+        json.dump(stats.to_dict(), out, indent=2)
+        out.write("\n")
+
+if __name__ == "__main__":
+    try:
+        main()
+    except BrokenPipeError:
+        exit_on_broken_pipe()